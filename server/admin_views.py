@@ -20,11 +20,11 @@ class AuthModelMixin(ModelView):
 class UserAdminView(AuthModelMixin):
     column_display_pk = True
     # Don't display the password on the list of Users
-    column_exclude_list = list = ("password",)
+    column_exclude_list = list = ("password", "search_vector")
     column_default_sort = ("created_at", True)
 
     # Don't include the standard password field when creating or editing a User (but see below)
-    form_excluded_columns = ("password",)
+    form_excluded_columns = ("password", "search_vector")
 
     # Automatically display human-readable names for the current and available Roles when creating or editing a User
     column_auto_select_related = True
@@ -106,7 +106,7 @@ class KindAdminView(AuthModelMixin):
     column_filters = ("c", "h", "i", "s")
     column_searchable_list = ("id", "name", "short_description_nl", "created_at")
     can_set_page_size = True
-    form_excluded_columns = ["kind_to_tags", "kind_to_flavors"]
+    form_excluded_columns = ["kind_to_tags", "kind_to_flavors", "search_vector"]
     form_overrides = dict(description_nl=TextAreaField, description_en=TextAreaField)
 
 
@@ -124,4 +124,5 @@ class BaseAdminView(AuthModelMixin):
 
 class PriceAdminView(BaseAdminView):
     can_set_page_size = True
+    column_exclude_list = form_excluded_columns = ("search_vector",)
     column_default_sort = ("internal_product_id", False)
@@ -0,0 +1,133 @@
+"""Per shop map of what can be ordered and at which price, kept in memory so order validation doesn't need the
+database.
+
+A map is built from all price relations of a shop the first time it's needed and is valid for the `Shop.modified_at`
+it was built for. Every change of a price relation or its price sets `Shop.modified_at` in the transaction of the
+change (see apis.shop_changes), so every worker rebuilds its map on the next order after a change.
+"""
+import threading
+from collections import namedtuple
+
+import structlog
+from database import ShopToPrice
+from sqlalchemy.orm import contains_eager, load_only
+
+logger = structlog.get_logger(__name__)
+
+# Weight options of kinds: the ShopToPrice flag that enables it and the Price column it needs
+KIND_OPTIONS = {
+    "0,5 gram": ("use_half", "half"),
+    "1 gram": ("use_one", "one"),
+    "2,5 gram": ("use_two_five", "two_five"),
+    "5 gram": ("use_five", "five"),
+    "1 joint": ("use_joint", "joint"),
+}
+PIECE = "piece"
+
+# Grams of cannabis in the weight options of kinds, joints are taken from the price relation
+OPTION_GRAMS = {"0,5 gram": 0.5, "1 gram": 1, "2,5 gram": 2.5, "5 gram": 5}
+JOINT = "1 joint"
+# Grams in a joint, for price relations without `joint_grams`
+DEFAULT_JOINT_GRAMS = 0.4
+
+# A price relation as far as ordering is concerned: `prices` holds the options it can be ordered in
+Relation = namedtuple("Relation", ["item_id", "active", "prices", "joint_grams", "piece_grams"])
+# An order item resolved against the price relations of a shop
+PricedItem = namedtuple("PricedItem", ["price", "grams"])
+
+
+class ShopAvailability:
+    """Availability and prices of the price relations of a shop, by kind or product."""
+
+    def __init__(self, modified_at):
+        self.modified_at = modified_at
+        self.relations = {}
+        self.by_item = {}
+
+    def set(self, shop_to_price):
+        item_id = str(shop_to_price.kind_id or shop_to_price.product_id)
+        self.relations[str(shop_to_price.id)] = Relation(
+            item_id,
+            bool(shop_to_price.active),
+            relation_prices(shop_to_price),
+            shop_to_price.joint_grams,
+            shop_to_price.piece_grams,
+        )
+        self.by_item.setdefault(item_id, set()).add(str(shop_to_price.id))
+
+    def price(self, item):
+        """Resolve an order item against the price relations of its kind or product.
+
+        Returns the unit price and grams of cannabis of the item, or None when it can't be ordered. When the item can
+        be ordered from several price relations, the one with the price the customer saw is preferred.
+        """
+        option = item.get("description") if item.get("kind_id") else PIECE
+        item_id = item.get("kind_id") or item.get("product_id")
+        priced_items = []
+        for shop_to_price_id in self.by_item.get(str(item_id), ()):
+            relation = self.relations[shop_to_price_id]
+            if not relation.active or option not in relation.prices:
+                continue
+            if option == PIECE:
+                grams = relation.piece_grams or 0
+            elif option == JOINT:
+                grams = relation.joint_grams or DEFAULT_JOINT_GRAMS
+            else:
+                grams = OPTION_GRAMS[option]
+            priced_items.append(PricedItem(relation.prices[option], grams))
+        for priced_item in priced_items:
+            if priced_item.price == item.get("price"):
+                return priced_item
+        return priced_items[0] if priced_items else None
+
+
+def relation_prices(shop_to_price):
+    """The prices of the options a price relation can be ordered in: the enabled options that have a price."""
+    prices = {
+        description: getattr(shop_to_price.price, price_field)
+        for description, (use_field, price_field) in KIND_OPTIONS.items()
+        if getattr(shop_to_price, use_field) and getattr(shop_to_price.price, price_field)
+    }
+    if shop_to_price.use_piece and shop_to_price.price.piece:
+        prices[PIECE] = shop_to_price.price.piece
+    return prices
+
+
+_availability = {}
+_availability_lock = threading.Lock()
+
+
+def get_shop_availability(shop):
+    """Return the availability map of a shop, building it when it's missing or outdated."""
+    availability = _availability.get(str(shop.id))
+    if availability and availability.modified_at == shop.modified_at:
+        return availability
+
+    availability = ShopAvailability(shop.modified_at)
+    query = (
+        ShopToPrice.query.join(ShopToPrice.price)
+        .options(
+            load_only(
+                "id",
+                "active",
+                "kind_id",
+                "product_id",
+                "use_half",
+                "use_one",
+                "use_two_five",
+                "use_five",
+                "use_joint",
+                "use_piece",
+                "joint_grams",
+                "piece_grams",
+            ),
+            contains_eager(ShopToPrice.price).load_only("half", "one", "two_five", "five", "joint", "piece"),
+        )
+        .filter(ShopToPrice.shop_id == shop.id)
+    )
+    for shop_to_price in query:
+        availability.set(shop_to_price)
+    with _availability_lock:
+        _availability[str(shop.id)] = availability
+    logger.info("Built shop availability", shop_id=str(shop.id), relations=len(availability.relations))
+    return availability
@@ -0,0 +1,279 @@
+"""Filters of react-admin list requests, compiled to SQLAlchemy expressions.
+
+A filter is a JSON object like `{"name": "haze", "shop_id": "<uuid>", "price_gte": 10, "active": true}`. It's compiled once per model and
+signature: its keys with the kind of their values. Values are bound as parameters, so requests with the same signature
+reuse the compiled expression. Keys that aren't columns of the model are rejected before anything is queried.
+
+The `q` quick search matches a substring of one of the quick search columns. Models with a `search_vector` also match
+its words and sort the results on relevance.
+"""
+import json
+import operator
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import structlog
+from flask_restx import abort
+from sqlalchemy import (
+    Boolean,
+    Date,
+    DateTime,
+    Integer,
+    Numeric,
+    String,
+    and_,
+    any_,
+    bindparam,
+    cast,
+    func,
+    inspect,
+    or_,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
+
+logger = structlog.get_logger(__name__)
+
+# Suffixes of filter keys that compare the column with the value
+COMPARISONS = {"_gte": operator.ge, "_gt": operator.gt, "_lte": operator.le, "_lt": operator.lt, "_ne": operator.ne}
+# Suffix of filter keys that match the start of a text column
+PREFIX = "_prefix"
+QUICK_SEARCH = "q"
+
+# Expression of a filter signature, and its bind parameters with the filter key and transform of their values
+CompiledFilter = namedtuple("CompiledFilter", ["condition", "parameters"])
+
+
+def parse_filter(filter):
+    """Parse the JSON `filter` argument of a list request."""
+    try:
+        filters = json.loads(filter)
+    except ValueError:
+        abort(400, "Invalid filter: not JSON")
+    if not isinstance(filters, dict):
+        abort(400, "Invalid filter: not an object")
+    return filters
+
+
+@lru_cache(maxsize=None)
+def model_columns(model):
+    """Columns of a model by attribute name."""
+    return {attribute.key: getattr(model, attribute.key) for attribute in inspect(model).column_attrs}
+
+
+def model_column(model, key):
+    column = model_columns(model).get(key)
+    if column is None:
+        abort(400, f"Unknown column: {key}")
+    return column
+
+
+def value_kind(value):
+    """The part of a filter value that's compiled into the expression instead of bound."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, list):
+        return list
+    return None
+
+
+def filter_signature(filters):
+    return tuple(sorted((key, value_kind(value)) for key, value in filters.items() if value is not None))
+
+
+def bind_name(key, suffix=""):
+    return f"filter_{key}{suffix}"
+
+
+def substring(value):
+    return f"%{value}%"
+
+
+def prefix(value):
+    return f"{value}%"
+
+
+def as_is(value):
+    return value
+
+
+def to_uuid(value):
+    return uuid.UUID(str(value))
+
+
+def to_uuids(values):
+    return [to_uuid(value) for value in values]
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        raise ValueError("Not a number")
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def to_datetime(value):
+    """Parse an ISO 8601 date or timestamp to a naive UTC datetime, like the DateTime columns hold."""
+    moment = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def to_datetime_end(value):
+    """End of the period a date or timestamp stands for: the next day for a date, else the next microsecond."""
+    moment = to_datetime(value)
+    return moment + (timedelta(days=1) if len(str(value)) == 10 else timedelta(microseconds=1))
+
+
+def column_type(column):
+    """How a column is filtered: uuid, boolean, number, datetime, text or None for other types."""
+    if isinstance(column.type, UUID):
+        return "uuid"
+    if isinstance(column.type, Boolean):
+        return "boolean"
+    if isinstance(column.type, (Integer, Numeric)):
+        return "number"
+    if isinstance(column.type, (Date, DateTime)):
+        return "datetime"
+    if isinstance(column.type, String):
+        return "text"
+    return None
+
+
+# Parsing of the values of comparisons per column type
+COMPARISON_VALUES = {"uuid": to_uuid, "number": to_number, "datetime": to_datetime}
+
+UUID_ARRAY = ARRAY(UUID(as_uuid=True))
+
+
+def uuid_array(name):
+    """A bind parameter for a list of UUIDs, sent as one uuid[] value."""
+    return cast(bindparam(name, type_=UUID_ARRAY), UUID_ARRAY)
+
+
+def compile_list(column, key):
+    """A list of values: GET_MANY of react-admin on `id`, or a list filter on a foreign key or other column."""
+    if column_type(column) == "uuid":
+        return column == any_(uuid_array(bind_name(key))), [(bind_name(key), key, to_uuids)]
+    transform = COMPARISON_VALUES.get(column_type(column), as_is)
+    return (
+        column.in_(bindparam(bind_name(key), expanding=True)),
+        [(bind_name(key), key, lambda values: [transform(value) for value in values])],
+    )
+
+
+def text_match(column, parameter):
+    """Case insensitive match of a column, without a cast for text columns so their trigram indexes can be used."""
+    if isinstance(column.type, String):
+        return column.ilike(parameter)
+    return cast(column, String).ilike(parameter)
+
+
+def search_query(model):
+    """Full text query of the quick search of a model with a `search_vector`, None for other models."""
+    if "search_vector" not in model_columns(model):
+        return None
+    return func.plainto_tsquery("simple", bindparam(bind_name(QUICK_SEARCH, "_terms")))
+
+
+def compile_quick_search(model, quick_search_columns):
+    """The `q` filter: a substring of one of the quick search columns, or the words of the `search_vector`."""
+    pattern = bindparam(bind_name(QUICK_SEARCH))
+    conditions = [text_match(model_column(model, column), pattern) for column in quick_search_columns]
+    parameters = [(bind_name(QUICK_SEARCH), QUICK_SEARCH, substring)]
+    terms = search_query(model)
+    if terms is not None:
+        conditions.append(model_column(model, "search_vector").op("@@")(terms))
+        parameters.append((bind_name(QUICK_SEARCH, "_terms"), QUICK_SEARCH, str))
+    return or_(*conditions), parameters
+
+
+def compile_condition(model, key, kind, quick_search_columns):
+    """Compile one filter key: returns the condition and its bind parameters as (name, key, transform) tuples.
+
+    Values are matched the way the column type can be searched on: equality for ids and numbers, the period of a date
+    or timestamp, and a substring only for text. That keeps foreign key filters on their indexes.
+    """
+    parameter = bindparam(bind_name(key))
+    if kind is list:
+        return compile_list(model_column(model, key), key)
+    if key == QUICK_SEARCH:
+        return compile_quick_search(model, quick_search_columns)
+    columns = model_columns(model)
+    if key not in columns:
+        for suffix, compare in COMPARISONS.items():
+            if key.endswith(suffix) and key[: -len(suffix)] in columns:
+                column = columns[key[: -len(suffix)]]
+                transform = COMPARISON_VALUES.get(column_type(column), as_is)
+                return compare(column, parameter), [(bind_name(key), key, transform)]
+        if key.endswith(PREFIX) and key[: -len(PREFIX)] in columns:
+            return text_match(columns[key[: -len(PREFIX)]], parameter), [(bind_name(key), key, prefix)]
+    column = model_column(model, key)
+    filter_type = column_type(column)
+    if isinstance(kind, bool):
+        if filter_type != "boolean":
+            abort(400, f"Invalid value for {key}: {kind}")
+        return column.is_(kind), []
+    if filter_type == "uuid":
+        return column == parameter, [(bind_name(key), key, to_uuid)]
+    if filter_type == "number":
+        return column == parameter, [(bind_name(key), key, to_number)]
+    if filter_type == "datetime":
+        end = bindparam(bind_name(key, "_end"))
+        return (
+            and_(column >= parameter, column < end),
+            [(bind_name(key), key, to_datetime), (bind_name(key, "_end"), key, to_datetime_end)],
+        )
+    return text_match(column, parameter), [(bind_name(key), key, substring)]
+
+
+@lru_cache(maxsize=1024)
+def compile_filter(model, signature, quick_search_columns):
+    """Compile a filter signature of a model to one expression with bind parameters for the filter values."""
+    conditions = []
+    parameters = []
+    for key, kind in signature:
+        condition, condition_parameters = compile_condition(model, key, kind, quick_search_columns)
+        conditions.append(condition)
+        parameters.extend(condition_parameters)
+    return CompiledFilter(and_(*conditions), tuple(parameters))
+
+
+def filter_parameters(compiled_filter, filters):
+    """Values of the bind parameters of a compiled filter."""
+    parameters = {}
+    for name, key, transform in compiled_filter.parameters:
+        try:
+            parameters[name] = transform(filters[key])
+        except (TypeError, ValueError):
+            abort(400, f"Invalid value for {key}: {filters[key]}")
+    return parameters
+
+
+def search_rank(model, filters):
+    """Relevance of the rows of a model for the `q` filter, to sort search results on. None when not searching."""
+    if not (filters or {}).get(QUICK_SEARCH):
+        return None
+    terms = search_query(model)
+    if terms is None:
+        return None
+    return func.ts_rank(model_column(model, "search_vector"), terms)
+
+
+def requested_order(model, filters):
+    """Position of the rows of a model in the ids of a GET_MANY request, to return them in that order. None otherwise."""
+    if not isinstance((filters or {}).get("id"), list) or column_type(model_column(model, "id")) != "uuid":
+        return None
+    return func.array_position(uuid_array(bind_name("id")), model_column(model, "id"))
+
+
+def apply_filter(model, query, filters, quick_search_columns=("name",)):
+    """Filter a query of a model with a parsed react-admin filter."""
+    signature = filter_signature(filters or {})
+    if not signature:
+        return query
+    logger.info("Query parameters set to custom filter", filters=filters)
+    compiled_filter = compile_filter(model, signature, tuple(quick_search_columns))
+    return query.filter(compiled_filter.condition).params(**filter_parameters(compiled_filter, filters))
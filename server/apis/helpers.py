@@ -1,16 +1,21 @@
 import base64
 import json
 import os
-from ast import literal_eval
 from datetime import datetime
 from typing import Dict, List, Optional
 from uuid import UUID
 
 import boto3
 import structlog
+from apis.filters import apply_filter, model_column, parse_filter, requested_order, search_rank
+from apis.menu import get_or_rebuild_shop_menu
+from apis.menu_cache import notify_menu_invalidated
+from apis.order_events import publish_order_event
+from apis.totals import get_count_mode, query_page
 from database import Order, Shop, db
+from flask import Response, request
 from flask_restx import abort
-from sqlalchemy import String, cast, or_
+from sqlalchemy import tuple_
 from sqlalchemy.sql import expression
 from utils import validate_uuid4
 
@@ -63,17 +68,19 @@ def get_sort_from_args(args, default_sort="name", default_sort_order="ASC"):
 
 def get_filter_from_args(args, default_filter={}):
     if args["filter"]:
-        # print(args["filter"])
-        try:
-            filter = literal_eval(args["filter"].replace(":true", ":True").replace(":false", ":False"))
-            logger.info("Query parameters set to custom filter", filter=filter)
-            return filter
-        except:  # noqa: E722
-            logger.warning("Query parameters not parsable", args=args.get(["filter"], "No filter provided"))
+        filter = parse_filter(args["filter"])
+        logger.info("Query parameters set to custom filter", filter=filter)
+        return filter
     logger.info("Query parameters set to default filter", filter=default_filter)
     return default_filter
 
 
+def get_localized(item, field, lang):
+    """Get `<field>_<lang>` of an item, falling back to the other language when it's empty."""
+    fallback = "en" if lang == "nl" else "nl"
+    return getattr(item, f"{field}_{lang}") or getattr(item, f"{field}_{fallback}")
+
+
 def save(item):
     try:
         db.session.add(item)
@@ -120,6 +127,10 @@ def delete(item):
         abort(400, "DB error: {}".format(str(error)))
 
 
+def apply_filters(model, query, filters: Optional[Dict] = None, quick_search_columns: List = ["name"]):
+    return apply_filter(model, query, filters, quick_search_columns)
+
+
 def query_with_filters(
     model,
     query,
@@ -127,67 +138,89 @@ def query_with_filters(
     sort: List[str] = None,
     filters: Optional[Dict] = None,
     quick_search_columns: List = ["name"],
+    count_mode: Optional[str] = None,
 ):
-    if filters != "":
-        logger.info("filters dict", filters=filters)
-        for column, searchPhrase in filters.items():
-            if isinstance(searchPhrase, list):
-                logger.info(
-                    "Query parameters set to GET_MANY, ID column only", column=column, searchPhrase=searchPhrase
-                )
-                conditions = []
-                for item in searchPhrase:
-                    conditions.append(model.__dict__["id"] == item)
-                query = query.filter(or_(*conditions))
-            elif searchPhrase is not None:
-                logger.info(
-                    "Query parameters set to custom filter for column", column=column, searchPhrase=searchPhrase
-                )
-                if type(searchPhrase) == bool:
-                    query = query.filter(model.__dict__[column].is_(searchPhrase))
-                elif column.endswith("_gt"):
-                    query = query.filter(model.__dict__[column[:-3]] > searchPhrase)
-                elif column.endswith("_gte"):
-                    query = query.filter(model.__dict__[column[:-4]] >= searchPhrase)
-                elif column.endswith("_lte"):
-                    query = query.filter(model.__dict__[column[:-4]] <= searchPhrase)
-                elif column.endswith("_lt"):
-                    query = query.filter(model.__dict__[column[:-3]] < searchPhrase)
-                elif column.endswith("_ne"):
-                    query = query.filter(model.__dict__[column[:-3]] != searchPhrase)
-                elif column == "id":
-                    query = query.filter(cast(model.__dict__["id"], String).ilike("%" + searchPhrase + "%"))
-                elif column == "q":
-                    logger.debug(
-                        "Activating multi kolom filter", column=column, quick_search_columns=quick_search_columns
-                    )
-                    conditions = []
-                    for item in quick_search_columns:
-                        conditions.append(cast(model.__dict__[item], String).ilike("%" + searchPhrase + "%"))
-                    query = query.filter(or_(*conditions))
-                else:
-                    query = query.filter(cast(model.__dict__[column], String).ilike("%" + searchPhrase + "%"))
+    query = apply_filters(model, query, filters, quick_search_columns)
+    rank = search_rank(model, filters)
+    if rank is not None:
+        query = query.order_by(rank.desc())
+    position = requested_order(model, filters)
+    if position is not None:
+        query = query.order_by(position)
 
     if sort and len(sort) == 2:
         if sort[1].upper() == "DESC":
-            query = query.order_by(expression.desc(model.__dict__[sort[0]]))
+            query = query.order_by(expression.desc(model_column(model, sort[0])))
         else:
-            query = query.order_by(expression.asc(model.__dict__[sort[0]]))
+            query = query.order_by(expression.asc(model_column(model, sort[0])))
 
     range_start = int(range[0])
     range_end = int(range[1])
-    if len(range) >= 2:
-        total = query.count()
-        # Range is inclusive so we need to add one
-        range_length = max(range_end - range_start + 1, 0)
-        query = query.offset(range_start)
-        query = query.limit(range_length)
-    else:
-        total = query.count()
+    # Range is inclusive so we need to add one
+    range_length = max(range_end - range_start + 1, 0)
+    items, total = query_page(model, query, range_start, range_length, get_count_mode(count_mode))
+
+    content_range = f"items {range_start}-{range_end}/{'*' if total is None else total}"
 
-    content_range = f"items {range_start}-{range_end}/{total}"
+    return items, content_range
 
-    return query.all(), content_range
+
+def encode_cursor(item):
+    """Opaque cursor that points right after an item in a list sorted on `created_at` and `id`."""
+    position = json.dumps([item.created_at.isoformat(), str(item.id)])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), UUID(id)
+    except (AttributeError, TypeError, ValueError):
+        abort(400, "Invalid cursor")
+
+
+def query_with_cursor(
+    model, query, cursor=None, limit=20, filters: Optional[Dict] = None, count=False, quick_search_columns=["name"]
+):
+    """Keyset pagination: newest first, continuing after the `cursor` of the previous page instead of an offset.
+
+    Returns the items of the page, the cursor of the next page (None on the last page) and the total number of items
+    when `count` is set: that's a separate query over all items, so only ask for it when it's needed.
+    """
+    query = apply_filters(model, query, filters, quick_search_columns)
+    total = query.count() if count else None
+    if cursor:
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(*decode_cursor(cursor)))
+    items = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor, total
+
+
+def conditional_response(payload, etag, last_modified, mimetype="application/json", encodings=None):
+    """Wrap an already serialized payload in a response that honors If-None-Match and If-Modified-Since.
+
+    Unchanged resources are answered with an empty 304. Clients are allowed to keep a copy, but have to revalidate
+    it on every use.
+
+    `encodings` maps content codings to precompressed versions of the payload: the best one the client accepts is
+    sent as is, so nothing is compressed per request.
+    """
+    encodings = {encoding: body for encoding, body in (encodings or {}).items() if body}
+    encoding = request.accept_encodings.best_match(list(encodings)) if encodings else None
+    if encoding:
+        payload = encodings[encoding]
+        # Every representation needs its own strong ETag
+        etag = f"{etag}-{encoding}"
+
+    response = Response(payload, mimetype=mimetype)
+    if encodings:
+        response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 def upload_file(blob, file_name):
@@ -236,12 +269,15 @@ def sendMessageToWebSocketServer(payload):
 def invalidateShopCache(shop_id):
     item = load(Shop, shop_id)
     item.modified_at = datetime.utcnow()
-    payload = {"connectionType": "shop", "shopId": str(shop_id)}
-    sendMessageToWebSocketServer(payload)
     try:
         save(item)
     except Exception as e:
         abort(500, f"Error: {e}")
+    # Rebuild the menu snapshot before notifying: clients refetch the menu as soon as they get the message
+    get_or_rebuild_shop_menu(item.id)
+    notify_menu_invalidated(item.id, item.modified_at)
+    payload = {"connectionType": "shop", "shopId": str(shop_id)}
+    sendMessageToWebSocketServer(payload)
 
 
 def invalidateCompletedOrdersCache(order_id):
@@ -254,6 +290,7 @@ def invalidateCompletedOrdersCache(order_id):
         save(shop)
     except Exception as e:
         abort(500, f"Error: {e}")
+    publish_order_event(item, "completed_orders")
 
 
 def invalidatePendingOrdersCache(order_id):
@@ -266,3 +303,4 @@ def invalidatePendingOrdersCache(order_id):
         save(shop)
     except Exception as e:
         abort(500, f"Error: {e}")
+    publish_order_event(item, "pending_orders")
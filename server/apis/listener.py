@@ -0,0 +1,52 @@
+"""Listen for Postgres notifications in a background thread of a worker.
+
+Used to broadcast events to all workers with NOTIFY, without extra infrastructure.
+"""
+import select
+import threading
+import time
+
+import structlog
+from database import db
+
+logger = structlog.get_logger(__name__)
+
+
+def listen(app, channel, handle, on_connect=None, on_disconnect=None, poll_interval=5, retry_interval=5):
+    """Keep a connection listening on a channel and call `handle` with the payload of every notification.
+
+    Notifications sent while the connection is down are lost: `on_connect` and `on_disconnect` are called so the
+    caller can deal with that.
+    """
+    while True:
+        connection = None
+        try:
+            with app.app_context():
+                connection = db.get_engine(app).raw_connection()
+            # Not returned to the pool: this connection is only used for listening
+            connection.detach()
+            connection.connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {channel}")
+            if on_connect:
+                on_connect()
+            logger.info("Listening for notifications", channel=channel)
+            while True:
+                select.select([connection.connection], [], [], poll_interval)
+                connection.connection.poll()
+                while connection.connection.notifies:
+                    handle(connection.connection.notifies.pop(0).payload)
+        except Exception as e:
+            if on_disconnect:
+                on_disconnect()
+            logger.warning("Notification listener disconnected", channel=channel, error=str(e))
+            if connection:
+                connection.close()
+            time.sleep(retry_interval)
+
+
+def start_listener(app, channel, handle, on_connect=None, on_disconnect=None):
+    listener = threading.Thread(
+        target=listen, args=(app, channel, handle, on_connect, on_disconnect), name=f"{channel}-listener", daemon=True
+    )
+    listener.start()
+    return listener
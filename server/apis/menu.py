@@ -0,0 +1,573 @@
+import gzip
+import json
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import structlog
+from apis.menu_cache import menu_cache
+from database import Category, Kind, KindToStrain, Price, Shop, ShopMenu, ShopToPrice, ShopToPriceTombstone, db
+from flask_restx import fields, marshal
+from sqlalchemy import or_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import contains_eager, joinedload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = structlog.get_logger(__name__)
+
+strain_fields = {"name": fields.String}
+
+
+price_fields = {
+    "id": fields.String,
+    "internal_product_id": fields.String,
+    "active": fields.Boolean,
+    "new": fields.Boolean,
+    "category_id": fields.String,
+    "category_name": fields.String,
+    "category_name_en": fields.String,
+    "category_icon": fields.String,
+    "category_color": fields.String,
+    "category_order_number": fields.Integer,
+    "category_image_1": fields.String,
+    "category_image_2": fields.String,
+    "main_category_id": fields.String,
+    "main_category_name": fields.String,
+    "main_category_name_en": fields.String,
+    "main_category_icon": fields.String,
+    "main_category_order_number": fields.Integer,
+    "kind_id": fields.String,
+    "kind_image": fields.String,
+    "strains": fields.Nested(strain_fields),
+    "kind_name": fields.String,
+    "kind_short_description_nl": fields.String,
+    "kind_short_description_en": fields.String,
+    "product_id": fields.String,
+    "product_image": fields.String,
+    "product_name": fields.String,
+    "product_short_description_nl": fields.String,
+    "product_short_description_en": fields.String,
+    "kind_c": fields.Boolean,
+    "kind_h": fields.Boolean,
+    "kind_i": fields.Boolean,
+    "kind_s": fields.Boolean,
+    "half": fields.Float,
+    "one": fields.Float,
+    "two_five": fields.Float,
+    "five": fields.Float,
+    "joint": fields.Float,
+    "piece": fields.Float,
+    "created_at": fields.DateTime,
+    "modified_at": fields.DateTime,
+}
+
+shop_serializer_with_prices = {
+    "id": fields.String(),
+    "name": fields.String(required=True, description="Unique Shop"),
+    "description": fields.String(required=True, description="Shop description", default=False),
+    "prices": fields.Nested(price_fields),
+}
+
+
+MENU_VARIANTS = ("full", "compact", "columnar")
+
+COMPACT_PRICE_COLUMNS = [
+    "id",
+    "internal_product_id",
+    "active",
+    "new",
+    "category",
+    "kind",
+    "product",
+    "half",
+    "one",
+    "two_five",
+    "five",
+    "joint",
+    "piece",
+    "created_at",
+    "modified_at",
+]
+
+
+MENU_LANGUAGES = ("nl", "en")
+
+# Both languages are loaded for every menu: a language projection falls back to the other one when a text is empty
+MENU_KIND_COLUMNS = ["id", "name", "image_1", "short_description_nl", "short_description_en", "c", "h", "i", "s"]
+MENU_PRODUCT_COLUMNS = ["id", "name", "image_1", "short_description_nl", "short_description_en"]
+
+# Field in a language projection: the (nl, en) fields it's taken from
+LOCALIZED_PRICE_FIELDS = {
+    "category_name": ("category_name", "category_name_en"),
+    "main_category_name": ("main_category_name", "main_category_name_en"),
+    "kind_short_description": ("kind_short_description_nl", "kind_short_description_en"),
+    "product_short_description": ("product_short_description_nl", "product_short_description_en"),
+}
+
+# Fields of the lookup tables of the compact menu in a language projection
+LOCALIZED_LOOKUP_FIELDS = {
+    "categories": {"name": ("name", "name_en")},
+    "main_categories": {"name": ("name", "name_en")},
+    "kinds": {"short_description": ("short_description_nl", "short_description_en")},
+    "products": {"short_description": ("short_description_nl", "short_description_en")},
+}
+
+localized_price_fields = {
+    **{
+        field: value
+        for field, value in price_fields.items()
+        if not any(field in sources for sources in LOCALIZED_PRICE_FIELDS.values())
+    },
+    **{field: fields.String for field in LOCALIZED_PRICE_FIELDS},
+}
+
+localized_shop_serializer_with_prices = {
+    **shop_serializer_with_prices,
+    "prices": fields.Nested(localized_price_fields),
+}
+
+
+def localize(item, lang, localized_fields):
+    """Project the nl and en fields of a dict on one field in `lang`, falling back to the other language."""
+    for field, (nl, en) in localized_fields.items():
+        preferred, fallback = (en, nl) if lang == "en" else (nl, en)
+        value = item.get(preferred) or item.get(fallback)
+        item.pop(nl, None)
+        item.pop(en, None)
+        item[field] = value
+    return item
+
+
+def price_relation_to_dict(pr):
+    """Flatten a ShopToPrice relation into a price list row."""
+    return {
+        "id": pr.id,
+        "internal_product_id": pr.price.internal_product_id,
+        "active": pr.active,
+        "new": pr.new,
+        "category_id": pr.category_id,
+        "category_name": pr.category.name,
+        "category_name_en": pr.category.name_en,
+        "category_icon": pr.category.icon,
+        "category_color": pr.category.color,
+        "category_order_number": pr.category.order_number,
+        "category_image_1": pr.category.image_1,
+        "category_image_2": pr.category.image_2,
+        "main_category_id": pr.category.main_category.id if pr.category.main_category else "Unknown",
+        "main_category_name": pr.category.main_category.name if pr.category.main_category else "Unknown",
+        "main_category_name_en": pr.category.main_category.name_en if pr.category.main_category else "Unknown",
+        "main_category_icon": pr.category.main_category.icon if pr.category.main_category else "Unknown",
+        "main_category_order_number": pr.category.main_category.order_number if pr.category.main_category else 0,
+        "kind_id": pr.kind_id,
+        "kind_image": pr.kind.image_1 if pr.kind_id else None,
+        "kind_name": pr.kind.name if pr.kind_id else None,
+        "strains": [strain.strain for strain in pr.kind.kind_to_strains] if pr.kind_id else [],
+        "kind_short_description_nl": pr.kind.short_description_nl if pr.kind_id else None,
+        "kind_short_description_en": pr.kind.short_description_en if pr.kind_id else None,
+        "kind_c": pr.kind.c if pr.kind_id else None,
+        "kind_h": pr.kind.h if pr.kind_id else None,
+        "kind_i": pr.kind.i if pr.kind_id else None,
+        "kind_s": pr.kind.s if pr.kind_id else None,
+        "product_id": pr.product_id,
+        "product_image": pr.product.image_1 if pr.product_id else None,
+        "product_name": pr.product.name if pr.product_id else None,
+        "product_short_description_nl": pr.product.short_description_nl if pr.product_id else None,
+        "product_short_description_en": pr.product.short_description_en if pr.product_id else None,
+        "half": pr.price.half if pr.use_half else None,
+        "one": pr.price.one if pr.use_one else None,
+        "two_five": pr.price.two_five if pr.use_two_five else None,
+        "five": pr.price.five if pr.use_five else None,
+        "joint": pr.price.joint if pr.use_joint else None,
+        "piece": pr.price.piece if pr.use_piece else None,
+        "created_at": pr.created_at,
+        "modified_at": pr.modified_at,
+    }
+
+
+def price_relations_query(shop_id):
+    """Query the price relations that are visible in the menu of a shop, with all relations of a price row.
+
+    All relations that end up in a price row are loaded up front: one statement for the price relations with their
+    price, category, main category, kind and product, and one for the strains of all kinds. So the number of
+    queries doesn't depend on the size of the shop. The long descriptions of kinds and products aren't loaded.
+    """
+    return (
+        ShopToPrice.query.filter_by(shop_id=shop_id)
+        .join(ShopToPrice.price)
+        .join(ShopToPrice.category)
+        .options(
+            contains_eager(ShopToPrice.price),
+            contains_eager(ShopToPrice.category).joinedload(Category.main_category),
+            joinedload(ShopToPrice.kind).load_only(*MENU_KIND_COLUMNS),
+            joinedload(ShopToPrice.kind).selectinload(Kind.kind_to_strains).joinedload(KindToStrain.strain),
+            joinedload(ShopToPrice.product).load_only(*MENU_PRODUCT_COLUMNS),
+        )
+    )
+
+
+def build_shop_menu(shop, category_id=None, item_id=None, lang=None):
+    """Build the price list of a shop as a JSON serializable dict.
+
+    With a `category_id` only the rows of that category are included, in the order of the category. With an
+    `item_id` too, only the rows of that kind or product in the category. With a `lang` the texts are only
+    included in that language.
+    """
+    query = price_relations_query(shop.id)
+    if category_id:
+        query = query.filter(ShopToPrice.category_id == category_id).order_by(
+            ShopToPrice.order_number, Price.piece, Price.joint, Price.one, Price.five, Price.half, Price.two_five
+        )
+        if item_id:
+            query = query.filter(or_(ShopToPrice.kind_id == item_id, ShopToPrice.product_id == item_id))
+    else:
+        query = query.order_by(
+            Category.name, Price.piece, Price.joint, Price.one, Price.five, Price.half, Price.two_five
+        )
+    prices = [price_relation_to_dict(pr) for pr in query.all()]
+    menu = {"id": shop.id, "name": shop.name, "description": shop.description, "prices": prices}
+    if lang:
+        menu["prices"] = [localize(row, lang, LOCALIZED_PRICE_FIELDS) for row in prices]
+        return marshal(menu, localized_shop_serializer_with_prices)
+    return marshal(menu, shop_serializer_with_prices)
+
+
+def build_compact_shop_menu(shop, columnar=False, lang=None):
+    """Build the price list of a shop with categories, main categories, kinds and products as lookup tables.
+
+    Price rows refer to those by their index in the lookup table, and only carry the fields that belong to the price
+    relation itself. Rows are lists ordered as `columns`, or when `columnar` is set one list per column. With a
+    `lang` the texts are only included in that language.
+    """
+    price_relations = (
+        price_relations_query(shop.id)
+        .order_by(Category.name, Price.piece, Price.joint, Price.one, Price.five, Price.half, Price.two_five)
+        .all()
+    )
+    lookups = {"categories": {}, "main_categories": {}, "kinds": {}, "products": {}}
+
+    def index_of(table, item, to_dict):
+        if item is None:
+            return None
+        if item.id not in lookups[table]:
+            lookups[table][item.id] = (len(lookups[table]), to_dict(item))
+        return lookups[table][item.id][0]
+
+    def main_category_to_dict(main_category):
+        return {
+            "id": str(main_category.id),
+            "name": main_category.name,
+            "name_en": main_category.name_en,
+            "icon": main_category.icon,
+            "order_number": main_category.order_number,
+        }
+
+    def category_to_dict(category):
+        return {
+            "id": str(category.id),
+            "name": category.name,
+            "name_en": category.name_en,
+            "icon": category.icon,
+            "color": category.color,
+            "order_number": category.order_number,
+            "image_1": category.image_1,
+            "image_2": category.image_2,
+            "main_category": index_of("main_categories", category.main_category, main_category_to_dict),
+        }
+
+    def kind_to_dict(kind):
+        return {
+            "id": str(kind.id),
+            "image": kind.image_1,
+            "name": kind.name,
+            "strains": [kind_to_strain.strain.name for kind_to_strain in kind.kind_to_strains],
+            "short_description_nl": kind.short_description_nl,
+            "short_description_en": kind.short_description_en,
+            "c": kind.c,
+            "h": kind.h,
+            "i": kind.i,
+            "s": kind.s,
+        }
+
+    def product_to_dict(product):
+        return {
+            "id": str(product.id),
+            "image": product.image_1,
+            "name": product.name,
+            "short_description_nl": product.short_description_nl,
+            "short_description_en": product.short_description_en,
+        }
+
+    rows = [
+        [
+            str(pr.id),
+            pr.price.internal_product_id,
+            pr.active,
+            pr.new,
+            index_of("categories", pr.category, category_to_dict),
+            index_of("kinds", pr.kind, kind_to_dict),
+            index_of("products", pr.product, product_to_dict),
+            pr.price.half if pr.use_half else None,
+            pr.price.one if pr.use_one else None,
+            pr.price.two_five if pr.use_two_five else None,
+            pr.price.five if pr.use_five else None,
+            pr.price.joint if pr.use_joint else None,
+            pr.price.piece if pr.use_piece else None,
+            pr.created_at.isoformat() if pr.created_at else None,
+            pr.modified_at.isoformat() if pr.modified_at else None,
+        ]
+        for pr in price_relations
+    ]
+    prices = {"columns": COMPACT_PRICE_COLUMNS, "rows": rows}
+    if columnar:
+        prices = {column: [row[i] for row in rows] for i, column in enumerate(COMPACT_PRICE_COLUMNS)}
+
+    menu = {"id": str(shop.id), "name": shop.name, "description": shop.description}
+    for table, items in lookups.items():
+        menu[table] = [item for _, item in items.values()]
+        if lang:
+            menu[table] = [localize(item, lang, LOCALIZED_LOOKUP_FIELDS[table]) for item in menu[table]]
+    menu["prices"] = prices
+    return menu
+
+
+def menu_variant(format="full", lang=None, category_id=None, item_id=None):
+    """Key of a menu snapshot: the format, optionally narrowed down to a category slice or a language."""
+    variant = f"category:{category_id}" if category_id else format
+    if item_id:
+        variant = f"{variant}:product:{item_id}"
+    if lang:
+        variant = f"{variant}:lang:{lang}"
+    return variant
+
+
+def build_shop_menu_variant(shop, variant):
+    """Build the menu of a shop as described by a `menu_variant` key."""
+    parts = variant.split(":")
+    if parts[0] == "category":
+        options = dict(zip(parts[::2], parts[1::2]))
+        return build_shop_menu(
+            shop, category_id=options["category"], item_id=options.get("product"), lang=options.get("lang")
+        )
+    options = dict(zip(parts[1::2], parts[2::2]))
+    if parts[0] == "compact":
+        return build_compact_shop_menu(shop, lang=options.get("lang"))
+    if parts[0] == "columnar":
+        return build_compact_shop_menu(shop, columnar=True, lang=options.get("lang"))
+    return build_shop_menu(shop, lang=options.get("lang"))
+
+
+def get_shop_menu_changes(shop_id, since, margin=timedelta(0)):
+    """Collect the price rows that were added, changed or removed in the menu of a shop after `since`.
+
+    Rows are stamped when they're flushed, but only visible when their transaction commits: rows changed up to `margin`
+    before `since` are included again, so a transaction that was still running at the previous request isn't missed.
+    Clients apply the changes idempotently, added rows can be known already.
+
+    Returns the changes together with the moment they were collected: that's the `since` for the next request.
+    """
+    until = datetime.utcnow()
+    after = since - margin
+    price_relations = price_relations_query(shop_id).filter(ShopToPrice.modified_at > after).all()
+    tombstones = (
+        ShopToPriceTombstone.query.filter(ShopToPriceTombstone.shop_id == shop_id)
+        .filter(ShopToPriceTombstone.deleted_at > after)
+        .all()
+    )
+    return {
+        "since": since,
+        "until": until,
+        "added": [price_relation_to_dict(pr) for pr in price_relations if pr.created_at > after],
+        "changed": [price_relation_to_dict(pr) for pr in price_relations if pr.created_at <= after],
+        "removed": [tombstone.shop_to_price_id for tombstone in tombstones],
+    }
+
+
+def purge_menu_tombstones(max_age):
+    """Delete the tombstones of price relations that were removed longer than `max_age` ago.
+
+    Menu deltas since before that can't tell which rows were removed: clients have to fetch the full menu.
+    """
+    count = ShopToPriceTombstone.query.filter(ShopToPriceTombstone.deleted_at < datetime.utcnow() - max_age).delete()
+    db.session.commit()
+    logger.info("Purged menu tombstones", tombstones=count)
+    return count
+
+
+# Menus are rebuilt in write requests, e.g. on every stock toggle: the highest levels take too long for a few percent
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 7
+
+
+def compress_payload(payload):
+    """Compress a serialized menu once: it's served many times for each build.
+
+    Returns the gzip and brotli encoded payloads; brotli is None when the brotli module isn't installed.
+    """
+    data = payload.encode("utf-8")
+    payload_gzip = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    payload_br = brotli.compress(data, quality=BROTLI_QUALITY) if brotli else None
+    return payload_gzip, payload_br
+
+
+def menu_encodings(menu):
+    """The precompressed payloads of a menu snapshot, by content coding."""
+    return {"br": menu.payload_br, "gzip": menu.payload_gzip}
+
+
+def rebuild_shop_menu(shop, variant="full"):
+    """Serialize a menu variant of a shop and store it as the new snapshot for the current `Shop.modified_at`."""
+    if not shop.modified_at:
+        shop.modified_at = datetime.utcnow()
+    # Taken before querying: every price change after this moment is newer than the snapshot
+    created_at = datetime.utcnow()
+    payload = json.dumps(build_shop_menu_variant(shop, variant), separators=(",", ":"))
+    payload_gzip, payload_br = compress_payload(payload)
+
+    # Upsert, so concurrent rebuilds of the same shop can't collide on the unique shop_id and variant
+    table = ShopMenu.__table__
+    statement = insert(table).values(
+        id=uuid.uuid4(),
+        shop_id=shop.id,
+        variant=variant,
+        version=1,
+        shop_modified_at=shop.modified_at,
+        payload=payload,
+        payload_gzip=payload_gzip,
+        payload_br=payload_br,
+        created_at=created_at,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.shop_id, table.c.variant],
+        set_={
+            "version": table.c.version + 1,
+            "shop_modified_at": statement.excluded.shop_modified_at,
+            "payload": statement.excluded.payload,
+            "payload_gzip": statement.excluded.payload_gzip,
+            "payload_br": statement.excluded.payload_br,
+            "created_at": statement.excluded.created_at,
+        },
+    )
+    db.session.execute(statement)
+    db.session.commit()
+
+    menu = ShopMenu.query.filter_by(shop_id=shop.id, variant=variant).first()
+    logger.info("Rebuilt shop menu", shop_id=str(shop.id), variant=variant, version=menu.version, size=len(payload))
+    return menu
+
+
+ETAG_DATETIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def shop_etag(modified_at, version=None):
+    """Strong ETag for data derived from a shop, optionally tied to a menu snapshot version."""
+    etag = modified_at.strftime(ETAG_DATETIME_FORMAT) if modified_at else "0"
+    return f"{etag}-{version}" if version else etag
+
+
+def menu_etag(menu):
+    """ETag of a menu snapshot: the moment it was built, its version and variant."""
+    etag = shop_etag(menu.created_at, menu.version)
+    return etag if menu.variant == "full" else f"{etag}-{menu.variant}"
+
+
+def parse_since(value):
+    """Parse an ISO 8601 timestamp or a menu ETag (the moment that snapshot was built) into a datetime.
+
+    ETags can be passed as they're echoed in If-None-Match: quoted and weak ones too.
+    """
+    if value.startswith("W/"):
+        value = value[2:]
+    value = value.strip('"')
+    try:
+        return datetime.strptime(value.split("-")[0], ETAG_DATETIME_FORMAT)
+    except ValueError:
+        since = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if since.tzinfo:
+        # All timestamps in the DB are naive UTC
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def get_shop_menu(shop_id, variant="full"):
+    """Return the current menu snapshot of a shop from the cache of this worker or else the database, or None."""
+    menu = menu_cache.get(shop_id, variant)
+    if not menu:
+        menu = get_fresh_shop_menu(shop_id, variant)
+        if menu:
+            menu_cache.put(menu)
+    return menu
+
+
+def get_fresh_shop_menu(shop_id, variant="full"):
+    """Return a menu snapshot of a shop when it's still current, None when it's missing or stale."""
+    return (
+        ShopMenu.query.join(Shop, Shop.id == ShopMenu.shop_id)
+        .filter(ShopMenu.shop_id == shop_id)
+        .filter(ShopMenu.variant == variant)
+        .filter(ShopMenu.shop_modified_at == Shop.modified_at)
+        .first()
+    )
+
+
+# Rebuilds in progress in this worker: key -> [lock, number of requests using it]
+_rebuilds = {}
+_rebuilds_lock = threading.Lock()
+
+
+@contextmanager
+def rebuild_lock(key, blocking=True):
+    """Lock a menu rebuild within this worker, yields whether the lock was acquired."""
+    with _rebuilds_lock:
+        entry = _rebuilds.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    acquired = entry[0].acquire(blocking)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            entry[0].release()
+        with _rebuilds_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _rebuilds[key]
+
+
+def lock_shop_menu_rebuild(key, blocking=True):
+    """Lock a menu rebuild across workers until the transaction ends, returns whether the lock was acquired."""
+    function = "pg_advisory_xact_lock" if blocking else "pg_try_advisory_xact_lock"
+    acquired = db.session.execute(text(f"SELECT {function}(hashtext(:key))"), {"key": key}).scalar()
+    return acquired is not False
+
+
+def get_or_rebuild_shop_menu(shop_id, variant="full", stale_while_revalidate=False):
+    """Return the current menu snapshot of a shop, building it when it's missing or stale.
+
+    Only one request rebuilds a snapshot at a time: concurrent requests for it wait and use its result. With
+    `stale_while_revalidate` they get the previous snapshot right away instead, when there is one.
+
+    Returns the snapshot and whether it's stale, or None when the shop doesn't exist.
+    """
+    key = f"shop_menu:{shop_id}:{variant}"
+    stale = ShopMenu.query.filter_by(shop_id=shop_id, variant=variant).first() if stale_while_revalidate else None
+    with rebuild_lock(key, blocking=not stale) as acquired:
+        if not acquired:
+            return stale, True
+        if not lock_shop_menu_rebuild(key, blocking=not stale):
+            db.session.rollback()
+            return stale, True
+        # Built by another request while waiting for the locks
+        menu = get_fresh_shop_menu(shop_id, variant)
+        if menu:
+            db.session.commit()
+            return menu, False
+        shop = Shop.query.filter_by(id=shop_id).first()
+        if not shop:
+            db.session.rollback()
+            return None, False
+        # Commits, which releases the advisory lock
+        return rebuild_shop_menu(shop, variant), False
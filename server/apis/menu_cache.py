@@ -0,0 +1,150 @@
+"""Process local cache of serialized shop menus.
+
+Every worker keeps its own LRU of menu snapshots, so serving a menu doesn't need the database in steady state. A
+cached menu is only safe while this worker learns about every change of a menu immediately: invalidations are
+broadcast to all workers with Postgres LISTEN/NOTIFY, and the cache only serves menus while it's listening.
+"""
+import json
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+import structlog
+from apis.listener import start_listener
+from database import db
+from sqlalchemy import text
+
+logger = structlog.get_logger(__name__)
+
+MENU_CACHE_CHANNEL = "shop_menu_invalidated"
+
+# Detached copy of a ShopMenu: safe to share between requests and threads
+CachedMenu = namedtuple(
+    "CachedMenu",
+    ["shop_id", "variant", "version", "shop_modified_at", "payload", "payload_gzip", "payload_br", "created_at"],
+)
+
+
+def menu_size(menu):
+    """Bytes taken by the payloads of a menu."""
+    return sum(len(payload) for payload in (menu.payload, menu.payload_gzip, menu.payload_br) if payload)
+
+
+class MenuCache:
+    """LRU of menu snapshots by shop and variant, bounded by the total size of their payloads."""
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.listening = False
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._menus = OrderedDict()
+        # Latest `Shop.modified_at` this worker was notified of: older menus are never cached again
+        self._modified_at = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes) and self.listening
+
+    def get(self, shop_id, variant):
+        if not self.enabled:
+            return None
+        with self._lock:
+            menu = self._menus.get((str(shop_id), variant))
+            if not menu:
+                self.misses += 1
+                return None
+            self._menus.move_to_end((str(shop_id), variant))
+            self.hits += 1
+            return menu
+
+    def put(self, menu):
+        """Cache a menu snapshot, unless a newer version of the shop was announced in the meantime."""
+        if not self.enabled:
+            return
+        menu = CachedMenu(*(getattr(menu, field) for field in CachedMenu._fields))
+        key = (str(menu.shop_id), menu.variant)
+        size = menu_size(menu)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            modified_at = self._modified_at.get(key[0])
+            if modified_at and menu.shop_modified_at < modified_at:
+                return
+            if key in self._menus:
+                self.size -= menu_size(self._menus.pop(key))
+            self._menus[key] = menu
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._menus.popitem(last=False)
+                self.size -= menu_size(evicted)
+
+    def invalidate(self, shop_id, modified_at=None):
+        """Drop all menus of a shop."""
+        with self._lock:
+            shop_id = str(shop_id)
+            if modified_at and modified_at > self._modified_at.get(shop_id, modified_at.min):
+                self._modified_at[shop_id] = modified_at
+            for key in [key for key in self._menus if key[0] == shop_id]:
+                self.size -= menu_size(self._menus.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._menus.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "menus": len(self._menus),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+menu_cache = MenuCache()
+
+
+NOTIFY_MENU_INVALIDATED = text("SELECT pg_notify(:channel, :payload)")
+
+
+def menu_invalidated_parameters(shop_id, modified_at=None):
+    """Parameters of NOTIFY_MENU_INVALIDATED for a shop: it's delivered when the transaction that sends it commits."""
+    payload = json.dumps({"shopId": str(shop_id), "modifiedAt": modified_at.isoformat() if modified_at else None})
+    return {"channel": MENU_CACHE_CHANNEL, "payload": payload}
+
+
+def notify_menu_invalidated(shop_id, modified_at=None):
+    """Tell the menu caches of all workers that the menus of a shop older than `modified_at` are outdated."""
+    db.session.execute(NOTIFY_MENU_INVALIDATED, menu_invalidated_parameters(shop_id, modified_at))
+    db.session.commit()
+    menu_cache.invalidate(shop_id, modified_at)
+
+
+def handle_notification(payload):
+    message = json.loads(payload)
+    modified_at = datetime.fromisoformat(message["modifiedAt"]) if message["modifiedAt"] else None
+    menu_cache.invalidate(message["shopId"], modified_at)
+
+
+def menu_cache_connected():
+    # Notifications could have been missed while not listening
+    menu_cache.clear()
+    menu_cache.listening = True
+
+
+def menu_cache_disconnected():
+    menu_cache.listening = False
+    menu_cache.clear()
+
+
+def start_menu_cache(app):
+    """Enable the menu cache of this worker when MENU_CACHE_MAX_BYTES is configured."""
+    menu_cache.max_bytes = app.config["MENU_CACHE_MAX_BYTES"]
+    if not menu_cache.max_bytes:
+        return None
+    return start_listener(app, MENU_CACHE_CHANNEL, handle_notification, menu_cache_connected, menu_cache_disconnected)
@@ -0,0 +1,114 @@
+"""Broker for order events of a shop, streamed to bar staff screens with Server-Sent Events.
+
+By default the broker is local: it only reaches subscribers in the worker that published the event, fine for tests and
+a single worker. With ORDER_EVENTS_BROKER=postgres events are broadcast to the brokers of all workers with NOTIFY.
+"""
+import json
+import queue
+import threading
+
+import structlog
+from apis.listener import start_listener
+from database import db
+from flask_restx import fields, marshal
+from sqlalchemy import text
+
+logger = structlog.get_logger(__name__)
+
+ORDER_EVENTS_CHANNEL = "order_events"
+# Postgres drops notifications with a payload of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7900
+
+order_event_line_fields = {
+    "description": fields.String,
+    "price": fields.Float,
+    "kind_id": fields.String,
+    "kind_name": fields.String,
+    "product_id": fields.String,
+    "product_name": fields.String,
+    "quantity": fields.Integer,
+}
+
+order_event_fields = {
+    "id": fields.String,
+    "shop_id": fields.String,
+    "customer_order_id": fields.Integer,
+    "order_info": fields.Nested(order_event_line_fields),
+    "total": fields.Float,
+    "status": fields.String,
+    "notes": fields.String,
+    "created_at": fields.DateTime,
+    "completed_at": fields.DateTime,
+    "table_id": fields.String,
+}
+
+
+class OrderEventBroker:
+    """Fans out the order events of a shop to the subscribers in this worker, or to those of all workers when
+    `broadcast` is set."""
+
+    def __init__(self, max_queued_events=100):
+        self.max_queued_events = max_queued_events
+        self.broadcast = False
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, shop_id):
+        events = queue.Queue(maxsize=self.max_queued_events)
+        with self._lock:
+            self._subscribers.setdefault(str(shop_id), set()).add(events)
+        return events
+
+    def unsubscribe(self, shop_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(str(shop_id), set())
+            subscribers.discard(events)
+            if not subscribers:
+                self._subscribers.pop(str(shop_id), None)
+
+    def publish(self, shop_id, event):
+        if not self.broadcast:
+            self.deliver(shop_id, event)
+            return
+        payload = json.dumps({"shopId": str(shop_id), "event": event})
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            # Too big for a notification: subscribers fetch the order themselves
+            event = {**event, "order": {"id": event["order"]["id"], "status": event["order"]["status"]}}
+            payload = json.dumps({"shopId": str(shop_id), "event": event})
+        db.session.execute(
+            text("SELECT pg_notify(:channel, :payload)"), {"channel": ORDER_EVENTS_CHANNEL, "payload": payload}
+        )
+        db.session.commit()
+
+    def deliver(self, shop_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(str(shop_id), ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                logger.warning("Dropping order event for a slow subscriber", shop_id=str(shop_id))
+
+    def handle_notification(self, payload):
+        message = json.loads(payload)
+        self.deliver(message["shopId"], message["event"])
+
+
+order_event_broker = OrderEventBroker()
+
+
+def publish_order_event(order, event_type):
+    """Publish a new or changed order to the event streams of its shop, after it's committed."""
+    event = {"type": event_type, "order": marshal(order, order_event_fields)}
+    try:
+        order_event_broker.publish(order.shop_id, event)
+    except Exception as e:
+        logger.warning("Order event not published", order_id=str(order.id), error=str(e))
+
+
+def start_order_event_broker(app):
+    """Set up the order event broker of this worker as configured by ORDER_EVENTS_BROKER."""
+    if app.config["ORDER_EVENTS_BROKER"] != "postgres":
+        return None
+    order_event_broker.broadcast = True
+    return start_listener(app, ORDER_EVENTS_CHANNEL, order_event_broker.handle_notification)
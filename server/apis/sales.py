@@ -0,0 +1,213 @@
+"""Sales of shops per day and kind or product.
+
+Order lines are written with their order. They're added to the daily rollups in batches by `roll_up_sales`, run with
+`flask roll-up-sales` from cron, so reports never scan orders or parse `order_info` and the order path doesn't update
+rollup rows that every order of a shop would contend on.
+
+Rolling up recomputes the days of a batch of new and changed lines from the lines of completed orders, so later changes
+correct the rollups instead of being added to them. Changing the status or table of an order puts its lines back in
+the queue, changing its items, shop or creation time replaces them. Replaced lines and lines of deleted orders lose
+their order: they're deleted once their day is recomputed. Days are calendar days in the `SALES_TIMEZONE` of the app.
+"""
+import uuid
+from datetime import datetime
+
+import structlog
+from apis.availability import get_shop_availability
+from database import Kind, Order, OrderLine, Product, Shop, ShopSalesDaily, db
+from flask import current_app
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+logger = structlog.get_logger(__name__)
+
+# Orders of the test table are completed right away, but aren't sales
+TEST_TABLE_ID = "0999fbcd-a72b-4cc2-abbe-41ccd466cdaf"
+
+# Columns of orders that decide whether their lines are sales
+SALES_COLUMNS = ("status", "table_id")
+# Columns of orders that their lines are written from
+LINE_COLUMNS = ("order_info", "shop_id", "created_at")
+
+# Takes a batch of new and changed lines out of the queue: returns the days they're on, with the number of lines
+TAKE_CHANGED_LINES = text(
+    """
+    WITH batch AS (
+        SELECT id
+        FROM order_lines
+        WHERE rolled_up_at IS NULL OR order_id IS NULL
+        ORDER BY created_at
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    ), lines AS (
+        UPDATE order_lines SET rolled_up_at = :now FROM batch
+        WHERE order_lines.id = batch.id AND order_lines.order_id IS NOT NULL
+        RETURNING order_lines.shop_id, order_lines.created_at
+    ), removed AS (
+        DELETE FROM order_lines USING batch
+        WHERE order_lines.id = batch.id AND order_lines.order_id IS NULL
+        RETURNING order_lines.shop_id, order_lines.created_at
+    )
+    SELECT shop_id, (created_at AT TIME ZONE 'UTC' AT TIME ZONE :timezone)::date AS day, COUNT(*) AS count
+    FROM (SELECT * FROM lines UNION ALL SELECT * FROM removed) AS changed
+    GROUP BY 1, 2
+    """
+)
+
+# Recomputes the sales of days of shops from the lines of their completed orders
+ROLL_UP_SALES = text(
+    """
+    WITH days AS (
+        SELECT * FROM unnest(CAST(:shop_ids AS uuid[]), CAST(:days AS date[])) AS days(shop_id, day)
+    ), sales AS (
+        SELECT
+            days.shop_id,
+            days.day,
+            COALESCE(order_lines.kind_id, order_lines.product_id) AS item_id,
+            order_lines.kind_id,
+            order_lines.product_id,
+            SUM(order_lines.quantity) AS quantity,
+            SUM(order_lines.grams) AS grams,
+            SUM(order_lines.price * order_lines.quantity) AS revenue
+        FROM days
+        JOIN order_lines ON order_lines.shop_id = days.shop_id
+            -- A margin of a day around the day in UTC, so the index on the creation time can be used
+            AND order_lines.created_at >= days.day - 1
+            AND order_lines.created_at < days.day + 2
+            AND (order_lines.created_at AT TIME ZONE 'UTC' AT TIME ZONE :timezone)::date = days.day
+        JOIN orders ON orders.id = order_lines.order_id
+        WHERE orders.status = 'complete'
+            AND orders.table_id IS DISTINCT FROM :test_table_id
+            AND COALESCE(order_lines.kind_id, order_lines.product_id) IS NOT NULL
+        GROUP BY days.shop_id, days.day, order_lines.kind_id, order_lines.product_id
+    ), rolled_up AS (
+        INSERT INTO shop_sales_daily
+            (id, shop_id, day, item_id, kind_id, product_id, quantity, grams, revenue, updated_at)
+        SELECT
+            md5(shop_id::text || day::text || item_id::text)::uuid,
+            shop_id,
+            day,
+            item_id,
+            kind_id,
+            product_id,
+            quantity,
+            grams,
+            revenue,
+            :now
+        FROM sales
+        ON CONFLICT (shop_id, day, item_id) DO UPDATE SET
+            quantity = EXCLUDED.quantity,
+            grams = EXCLUDED.grams,
+            revenue = EXCLUDED.revenue,
+            updated_at = EXCLUDED.updated_at
+    )
+    DELETE FROM shop_sales_daily USING days
+    WHERE shop_sales_daily.shop_id = days.shop_id
+        AND shop_sales_daily.day = days.day
+        AND NOT EXISTS (
+            SELECT 1 FROM sales
+            WHERE sales.shop_id = days.shop_id AND sales.day = days.day AND sales.item_id = shop_sales_daily.item_id
+        )
+    """
+)
+
+
+def order_lines(order, shop):
+    """The order lines of an order, with the grams of cannabis from the price relations of the shop."""
+    availability = get_shop_availability(shop)
+    lines = []
+    for item in order.order_info:
+        priced_item = availability.price(item)
+        lines.append(
+            OrderLine(
+                id=uuid.uuid4(),
+                shop_id=shop.id,
+                kind_id=item.get("kind_id") or None,
+                product_id=item.get("product_id") or None,
+                description=item.get("description"),
+                price=priced_item.price if priced_item else item.get("price"),
+                quantity=item.get("quantity"),
+                grams=priced_item.grams * item["quantity"] if priced_item else 0,
+                created_at=order.created_at or datetime.utcnow(),
+            )
+        )
+    return lines
+
+
+def roll_up_sales(batch_size=1000):
+    """Recompute the daily sales of the days of new and changed order lines, one batch of lines per transaction.
+
+    Concurrent runs skip each other's batches. Returns the number of order lines that were handled.
+    """
+    timezone = current_app.config["SALES_TIMEZONE"]
+    handled = 0
+    while True:
+        now = datetime.utcnow()
+        rows = db.session.execute(
+            TAKE_CHANGED_LINES, {"batch_size": batch_size, "now": now, "timezone": timezone}
+        ).fetchall()
+        shop_days = [(str(row.shop_id), row.day) for row in rows if row.shop_id]
+        if shop_days:
+            parameters = {
+                "shop_ids": [shop_id for shop_id, _ in shop_days],
+                "days": [day for _, day in shop_days],
+                "now": now,
+                "timezone": timezone,
+                "test_table_id": TEST_TABLE_ID,
+            }
+            db.session.execute(ROLL_UP_SALES, parameters)
+        db.session.commit()
+        count = sum(row.count for row in rows)
+        handled += count
+        if count < batch_size:
+            break
+    logger.info("Rolled up sales", order_lines=handled)
+    return handled
+
+
+def requeue_order_lines(session, flush_context, instances):
+    """Put the lines of changed orders back in the queue of `roll_up_sales`, so the days they're on are recomputed."""
+    for order in session.dirty:
+        if not isinstance(order, Order):
+            continue
+        state = inspect(order)
+        if any(state.attrs[key].history.has_changes() for key in LINE_COLUMNS):
+            # The previous lines lose their order, so their days are recomputed as well
+            order.lines = order_lines(order, session.query(Shop).get(order.shop_id))
+        elif any(state.attrs[key].history.has_changes() for key in SALES_COLUMNS):
+            for line in order.lines:
+                line.rolled_up_at = None
+
+
+def track_order_changes():
+    """Listen to the flushes of all sessions for changes of orders that were rolled up."""
+    if not event.contains(Session, "before_flush", requeue_order_lines):
+        event.listen(Session, "before_flush", requeue_order_lines)
+
+
+def get_shop_sales(shop_id, start=None, end=None, kind_id=None, product_id=None):
+    """Daily sales of a shop from the rollups, with the names of the kinds and products."""
+    query = (
+        db.session.query(
+            ShopSalesDaily.day,
+            ShopSalesDaily.kind_id,
+            Kind.name.label("kind_name"),
+            ShopSalesDaily.product_id,
+            Product.name.label("product_name"),
+            ShopSalesDaily.quantity,
+            ShopSalesDaily.grams,
+            ShopSalesDaily.revenue,
+        )
+        .outerjoin(Kind, Kind.id == ShopSalesDaily.kind_id)
+        .outerjoin(Product, Product.id == ShopSalesDaily.product_id)
+        .filter(ShopSalesDaily.shop_id == shop_id)
+    )
+    if start:
+        query = query.filter(ShopSalesDaily.day >= start)
+    if end:
+        query = query.filter(ShopSalesDaily.day <= end)
+    if kind_id:
+        query = query.filter(ShopSalesDaily.kind_id == kind_id)
+    if product_id:
+        query = query.filter(ShopSalesDaily.product_id == product_id)
+    return [row._asdict() for row in query.order_by(ShopSalesDaily.day, ShopSalesDaily.item_id)]
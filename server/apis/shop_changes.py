@@ -0,0 +1,112 @@
+"""Mark shops as modified when data that's shown in their menus changes.
+
+Menu snapshots, the menu caches of the workers and the availability maps are valid for the `Shop.modified_at` they
+were built for. Every flush that changes a price relation, price, category, main category, kind, product or strain
+sets `modified_at` of the price relations that show it and of their shops, in the transaction of the change. So the
+menus can't go stale, whether the change is made by an endpoint, an admin view or a CLI command, and menu deltas
+include the price rows of a renamed category or a changed price.
+"""
+from datetime import datetime
+
+import structlog
+from apis.menu_cache import NOTIFY_MENU_INVALIDATED, menu_cache, menu_invalidated_parameters
+from database import Category, Kind, KindToStrain, MainCategory, Price, Product, Shop, ShopToPrice, Strain
+from sqlalchemy import event, inspect, or_, select
+from sqlalchemy.orm import Session
+
+logger = structlog.get_logger(__name__)
+
+# Shops modified by the flushes of a transaction, by id with their new `modified_at`
+MODIFIED_SHOPS = "modified_shops"
+
+# Models shown in the price rows of a menu, with the condition on the price relations that show them
+SHOWN_IN = {
+    Price: lambda ids: ShopToPrice.price_id.in_(ids),
+    Category: lambda ids: ShopToPrice.category_id.in_(ids),
+    MainCategory: lambda ids: ShopToPrice.category_id.in_(
+        select([Category.id]).where(Category.main_category_id.in_(ids))
+    ),
+    Kind: lambda ids: ShopToPrice.kind_id.in_(ids),
+    Product: lambda ids: ShopToPrice.product_id.in_(ids),
+    Strain: lambda ids: ShopToPrice.kind_id.in_(select([KindToStrain.kind_id]).where(KindToStrain.strain_id.in_(ids))),
+}
+# Columns with the shop of an item, the old and the new shop are modified when it moves
+SHOP_COLUMNS = {ShopToPrice: "shop_id", Category: "shop_id", MainCategory: "shop_id"}
+# Columns of the shop itself that are part of its menu
+SHOP_MENU_COLUMNS = ("name", "description")
+
+
+def column_values(item, key):
+    """The current and previous values of a column of an item that's being flushed."""
+    history = inspect(item).attrs[key].history
+    return {value for value in (*history.added, *history.unchanged, *history.deleted) if value is not None}
+
+
+def changed_items(session):
+    """Items of the flush that were added, deleted or have changed columns."""
+    yield from session.new
+    yield from session.deleted
+    for item in session.dirty:
+        if session.is_modified(item, include_collections=False):
+            yield item
+
+
+def modify_shops(session, flush_context):
+    shop_ids = set()
+    shown = {}
+    for item in changed_items(session):
+        model = type(item)
+        if model in SHOWN_IN:
+            shown.setdefault(model, set()).add(item.id)
+        if model in SHOP_COLUMNS:
+            shop_ids.update(column_values(item, SHOP_COLUMNS[model]))
+        if model is KindToStrain:
+            shown.setdefault(Kind, set()).update(column_values(item, "kind_id"))
+        if model is Shop and item not in session.new:
+            if item in session.deleted or any(
+                inspect(item).attrs[key].history.has_changes() for key in SHOP_MENU_COLUMNS
+            ):
+                shop_ids.add(item.id)
+    if not shop_ids and not shown:
+        return
+
+    now = datetime.utcnow()
+    if shown:
+        relations = ShopToPrice.__table__
+        statement = (
+            relations.update()
+            .where(or_(*(SHOWN_IN[model](ids) for model, ids in shown.items())))
+            .values(modified_at=now)
+            .returning(relations.c.shop_id)
+        )
+        shop_ids.update(row.shop_id for row in session.execute(statement) if row.shop_id)
+    if not shop_ids:
+        return
+
+    shops = Shop.__table__
+    session.execute(shops.update().where(shops.c.id.in_(shop_ids)).values(modified_at=now))
+    for shop_id in shop_ids:
+        # Delivered to the menu caches of all workers when the transaction commits
+        session.execute(NOTIFY_MENU_INVALIDATED, menu_invalidated_parameters(shop_id, now))
+    session.info.setdefault(MODIFIED_SHOPS, {}).update({shop_id: now for shop_id in shop_ids})
+
+
+def invalidate_modified_shops(session):
+    for shop_id, modified_at in session.info.pop(MODIFIED_SHOPS, {}).items():
+        menu_cache.invalidate(shop_id, modified_at)
+        logger.info("Shop modified", shop_id=str(shop_id), modified_at=modified_at)
+
+
+def forget_modified_shops(session):
+    session.info.pop(MODIFIED_SHOPS, None)
+
+
+def track_shop_changes():
+    """Listen to the flushes of all sessions for changes of menus."""
+    for name, listener in (
+        ("after_flush", modify_shops),
+        ("after_commit", invalidate_modified_shops),
+        ("after_rollback", forget_modified_shops),
+    ):
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)
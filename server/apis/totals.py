@@ -0,0 +1,110 @@
+"""Totals of list requests, for the `Content-Range` header react-admin paginates with.
+
+Counting all rows that match a list request costs about as much as the page itself, so the way the total is found
+can be chosen per request with the `count_mode` argument, defaulting to LIST_COUNT_MODE:
+
+- exact: a separate `count()` query, cached for LIST_TOTALS_TTL seconds per query and parameters
+- windowed: `count(*) OVER ()` as an extra column of the page query, so the database only runs one statement
+- estimated: the row estimate of the planner for lists without conditions, windowed otherwise
+- none: no total, the header then ends in `/*`
+"""
+import threading
+import time
+
+import structlog
+from database import db
+from flask import current_app
+from flask_restx import abort
+from sqlalchemy import func, text
+
+logger = structlog.get_logger(__name__)
+
+COUNT_MODES = ("exact", "windowed", "estimated", "none")
+# Planner estimates of small tables are too far off to show, those are counted
+MIN_ESTIMATED_ROWS = 10000
+
+
+class TotalsCache:
+    """Totals of list queries that expire after a number of seconds."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            total, expires_at = self._totals.get(key, (None, 0))
+            if expires_at < time.monotonic():
+                self._totals.pop(key, None)
+                return None
+            return total
+
+    def put(self, key, total, ttl):
+        with self._lock:
+            if len(self._totals) >= self.max_entries:
+                now = time.monotonic()
+                self._totals = {key: value for key, value in self._totals.items() if value[1] >= now}
+                if len(self._totals) >= self.max_entries:
+                    self._totals.clear()
+            self._totals[key] = (total, time.monotonic() + ttl)
+
+    def clear(self):
+        with self._lock:
+            self._totals.clear()
+
+
+list_totals = TotalsCache()
+
+
+def get_count_mode(count_mode=None):
+    count_mode = count_mode or current_app.config["LIST_COUNT_MODE"]
+    if count_mode not in COUNT_MODES:
+        abort(400, f"count_mode should be one of {', '.join(COUNT_MODES)}")
+    return count_mode
+
+
+def query_key(query):
+    """The SQL and parameters of a query: a filter signature with its values and the conditions of the endpoint."""
+    statement = query.statement.compile(dialect=db.engine.dialect)
+    return str(statement), tuple(sorted((name, repr(value)) for name, value in statement.params.items()))
+
+
+def exact_total(query):
+    ttl = current_app.config["LIST_TOTALS_TTL"]
+    if not ttl:
+        return query.count()
+    key = query_key(query)
+    total = list_totals.get(key)
+    if total is None:
+        total = query.count()
+        list_totals.put(key, total, ttl)
+    return total
+
+
+def estimated_total(model):
+    """Row estimate of the planner for the table of a model, None when it's not estimated or too small to trust."""
+    estimate = db.session.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"), {"table": model.__tablename__}
+    ).scalar()
+    return estimate if estimate is not None and estimate >= MIN_ESTIMATED_ROWS else None
+
+
+def query_page(model, query, offset, limit, count_mode):
+    """Return the items of a page of a list query and the total of the list, None when it's not counted."""
+    page = query.offset(offset).limit(limit)
+    if count_mode == "none":
+        return page.all(), None
+    if count_mode == "exact":
+        return page.all(), exact_total(query)
+    if count_mode == "estimated" and query.whereclause is None:
+        total = estimated_total(model)
+        if total is not None:
+            items = page.all()
+            return items, max(total, offset + len(items))
+
+    rows = page.add_columns(func.count().over().label("total")).all()
+    if not rows:
+        # Past the last page there's no row to read the total from
+        return [], exact_total(query) if offset else 0
+    return [row[0] for row in rows], rows[0].total
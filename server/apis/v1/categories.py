@@ -11,6 +11,7 @@ from apis.helpers import (
     save,
     update,
 )
+from apis.totals import COUNT_MODES
 from database import Category
 from flask_restx import Namespace, Resource, fields, marshal_with
 from flask_security import roles_accepted
@@ -54,6 +55,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -69,7 +73,9 @@ class CategoryResourceList(Resource):
         sort = get_sort_from_args(args)
         filter = get_filter_from_args(args)
 
-        query_result, content_range = query_with_filters(Category, Category.query, range, sort, filter)
+        query_result, content_range = query_with_filters(
+            Category, Category.query, range, sort, filter, count_mode=args["count_mode"]
+        )
         for result in query_result:
             result.main_category_name = result.main_category.name if result.main_category else "Unknown"
             result.main_category_name_en = result.main_category.name_en if result.main_category else "Unknown"
@@ -12,6 +12,7 @@ from apis.helpers import (
     update,
     upload_file,
 )
+from apis.totals import COUNT_MODES
 from database import Category
 from flask import request
 from flask_restx import Namespace, Resource, fields, marshal_with, reqparse
@@ -37,6 +38,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 file_upload = reqparse.RequestParser()
 file_upload.add_argument("image_1", type=FileStorage, location="files", help="image_1")
@@ -59,7 +63,13 @@ class CategoryImageResourceList(Resource):
         filter = get_filter_from_args(args)
 
         query_result, content_range = query_with_filters(
-            Category, Category.query, range, sort, filter, quick_search_columns=["name", "image_1", "image_2"],
+            Category,
+            Category.query,
+            range,
+            sort,
+            filter,
+            quick_search_columns=["name", "image_1", "image_2"],
+            count_mode=args["count_mode"],
         )
 
         return query_result, 200, {"Content-Range": content_range}
@@ -5,6 +5,7 @@ import structlog
 from apis.helpers import (
     delete,
     get_filter_from_args,
+    get_localized,
     get_range_from_args,
     get_sort_from_args,
     load,
@@ -12,8 +13,9 @@ from apis.helpers import (
     save,
     update,
 )
+from apis.totals import COUNT_MODES
 from database import Kind
-from flask_restx import Namespace, Resource, fields, marshal_with
+from flask_restx import Namespace, Resource, fields, marshal, marshal_with
 from flask_security import roles_accepted
 
 logger = structlog.get_logger(__name__)
@@ -86,11 +88,24 @@ kind_serializer_with_relations = {
     "prices": fields.Nested(price_fields),
 }
 
+localized_kind_serializer_with_relations = {
+    **{
+        field: value
+        for field, value in kind_serializer_with_relations.items()
+        if not field.endswith("_nl") and not field.endswith("_en")
+    },
+    "short_description": fields.String(description="Description as shown in the price list"),
+    "description": fields.String(description="Description as shown in the detail view"),
+}
+
 
 parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -113,6 +128,7 @@ class KindResourceList(Resource):
             sort,
             filter,
             quick_search_columns=["name", "short_description_nl", "short_description_en"],
+            count_mode=args["count_mode"],
         )
         # Todo: return items from selected shop/category
         for kind in query_result:
@@ -147,12 +163,14 @@ class KindResourceList(Resource):
 
 detail_parser = api.parser()
 detail_parser.add_argument("shop", location="args", help="Optional shop id")
+detail_parser.add_argument(
+    "lang", location="args", choices=("nl", "en"), help="Only include descriptions in this language, default: both"
+)
 
 
 @api.route("/<id>")
 @api.doc("Kind detail operations.")
 class KindResource(Resource):
-    @marshal_with(kind_serializer_with_relations)
     @api.doc(parser=detail_parser)
     def get(self, id):
         """List Kind"""
@@ -207,7 +225,12 @@ class KindResource(Resource):
             if getattr(item, f"image_{i}"):
                 item.images_amount += 1
 
-        return item, 200
+        lang = args.get("lang")
+        if lang:
+            item.short_description = get_localized(item, "short_description", lang)
+            item.description = get_localized(item, "description", lang)
+            return marshal(item, localized_kind_serializer_with_relations), 200
+        return marshal(item, kind_serializer_with_relations), 200
 
     @roles_accepted("admin", "employee")
     @api.expect(kind_serializer)
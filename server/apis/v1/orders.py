@@ -1,8 +1,9 @@
 import datetime
+import queue
 import uuid
-from operator import or_
 
 import structlog
+from apis.availability import get_shop_availability
 from apis.helpers import (
     delete,
     get_filter_from_args,
@@ -11,16 +12,22 @@ from apis.helpers import (
     invalidateCompletedOrdersCache,
     invalidatePendingOrdersCache,
     load,
+    query_with_cursor,
     query_with_filters,
     save,
     update,
 )
-from database import Order, Shop, ShopToPrice
-from flask import request
+from apis.order_events import order_event_broker
+from apis.sales import order_lines
+from apis.totals import COUNT_MODES
+from database import Order, OrderIdempotencyKey, Shop, ShopOrderCounter, Table, db
+from flask import Response, current_app, json, request, stream_with_context
 from flask_login import current_user
-from flask_restx import Namespace, Resource, abort, fields, marshal_with
+from flask_restx import Namespace, Resource, abort, fields, inputs, marshal, marshal_with
 from flask_security import roles_accepted
-from sqlalchemy.orm import contains_eager, defer
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
 from utils import is_ip_allowed, validate_uuid4
 
 logger = structlog.get_logger(__name__)
@@ -103,70 +110,130 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
+shop_order_parser = parser.copy()
+shop_order_parser.add_argument(
+    "cursor", location="args", help="Cursor pagination: X-Next-Cursor of the previous page, empty for the first page"
+)
+shop_order_parser.add_argument("limit", location="args", type=int, help="Cursor pagination: page size, default=20")
+shop_order_parser.add_argument(
+    "count", location="args", type=inputs.boolean, default=False, help="Cursor pagination: include X-Total-Count"
+)
 
-def get_price_rules_total(order_items):
-    """Calculate the total number of grams."""
-    JOINT = 0.4
 
-    # Todo: add correct order line for 0.5 and 2.5
-    prices = {"0,5 gram": 0.5, "1 gram": 1, "2,5 gram": 2.5, "5 gram": 5, "joint": JOINT}
-    total = 0
-    for item in order_items:
-        if item["description"] in prices:
-            total = total + (prices[item["description"]] * item["quantity"])
+def list_shop_orders(query, args):
+    """List orders of a shop by cursor when asked for, or else by range."""
+    filter = get_filter_from_args(args)
+    if args["limit"] is not None and args["limit"] < 1:
+        abort(400, "Invalid limit: should be at least 1")
+    if args["cursor"] is None and not args["limit"]:
+        range = get_range_from_args(args)
+        sort = get_sort_from_args(args, "created_at", default_sort_order="DESC")
+        query_result, content_range = query_with_filters(
+            Order, query, range, sort, filter, count_mode=args["count_mode"]
+        )
+        return query_result, {"Content-Range": content_range}
+
+    limit = min(args["limit"] or 20, 100)
+    query_result, next_cursor, total = query_with_cursor(Order, query, args["cursor"], limit, filter, args["count"])
+    headers = {}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if total is not None:
+        headers["X-Total-Count"] = total
+    return query_result, headers
+
+
+def with_order_names(query):
+    """Load the user and table names shown in order lists in the list query itself, instead of per order."""
+    return query.options(joinedload(Order.user).load_only("first_name"), joinedload(Order.table).load_only("name"))
 
-    return total
 
+def next_customer_order_id(shop_id):
+    """Allocate the next customer order id of a shop.
 
-def get_first_unavailable_product_name(order_items, shop_id):
-    """Search for the first unavailable product and return it's name."""
-    products = (
-        ShopToPrice.query.join(ShopToPrice.price)
-        .options(contains_eager(ShopToPrice.price), defer("price_id"))
-        .filter(ShopToPrice.shop_id == shop_id)
-        .all()
+    The counter row stays locked until the transaction that inserts the order commits, so concurrent orders of the
+    shop can't get the same id.
+    """
+    table = ShopOrderCounter.__table__
+    statement = insert(table).values(id=uuid.uuid4(), shop_id=shop_id, last_customer_order_id=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.shop_id], set_={"last_customer_order_id": table.c.last_customer_order_id + 1}
+    ).returning(table.c.last_customer_order_id)
+    return db.session.execute(statement).scalar()
+
+
+def idempotency_keys_expire_at():
+    """Keys created before this moment are expired."""
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config["ORDER_IDEMPOTENCY_TTL"])
+
+
+def get_idempotent_response(shop_id, key):
+    """Return the response to an earlier submission of an order with this Idempotency-Key, if it didn't expire."""
+    idempotency_key = (
+        OrderIdempotencyKey.query.filter_by(shop_id=shop_id, key=key)
+        .filter(OrderIdempotencyKey.created_at >= idempotency_keys_expire_at())
+        .first()
     )
+    return idempotency_key.response if idempotency_key else None
+
+
+def claim_idempotency_key(shop_id, key):
+    """Claim an Idempotency-Key for the order that's being submitted, in its transaction.
+
+    Returns None when claimed, taking over the key when it expired. A concurrent submission with the same key waits
+    until the first one is committed and then gets its response instead.
+    """
+    table = OrderIdempotencyKey.__table__
+    statement = insert(table).values(id=uuid.uuid4(), shop_id=shop_id, key=key, created_at=datetime.datetime.utcnow())
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.shop_id, table.c.key],
+        set_={
+            "id": statement.excluded.id,
+            "created_at": statement.excluded.created_at,
+            "order_id": None,
+            "response": None,
+        },
+        where=table.c.created_at < idempotency_keys_expire_at(),
+    ).returning(table.c.id)
+    if db.session.execute(statement).scalar():
+        return None
+    return get_idempotent_response(shop_id, key)
+
+
+def purge_idempotency_keys():
+    """Delete the expired Idempotency-Keys of order submissions, run periodically by `flask purge-idempotency-keys`."""
+    count = OrderIdempotencyKey.query.filter(OrderIdempotencyKey.created_at < idempotency_keys_expire_at()).delete()
+    db.session.commit()
+    logger.info("Purged order idempotency keys", idempotency_keys=count)
+    return count
+
+
+def price_order(order_items, shop):
+    """Recompute an order from the prices of the shop, in one pass over its items.
+
+    The availability map is rebuilt when the shop was modified since it was built, which every change of its prices
+    does, so an order is never checked against prices that changed in another worker.
+
+    Returns the total, the grams of cannabis in the order and the names of the items that can't be ordered.
+    """
+    availability = get_shop_availability(shop)
+    total = 0
+    grams = 0
+    unavailable_product_names = []
     for item in order_items:
-        found_product = False  # Start False
-        for product in products:
-            if item.get("kind_id") and item["kind_id"] == str(product.kind_id):
-                if product.active:
-                    if item["description"] == "0,5 gram" and (not product.use_half or not product.price.half):
-                        logger.warning("Product is currently not available in 0.5 gram", kind_name=item["kind_name"])
-                    elif item["description"] == "1 gram" and (not product.use_one or not product.price.one):
-                        logger.warning("Product is currently not available in 1 gram", kind_name=item["kind_name"])
-                    elif item["description"] == "2,5 gram" and (not product.use_two_five or not product.price.two_five):
-                        logger.warning("Product is currently not available in 2.5 gram", kind_name=item["kind_name"])
-                    elif item["description"] == "5 gram" and (not product.use_five or not product.price.five):
-                        logger.warning("Product is currently not available in 5 gram", kind_name=item["kind_name"])
-                    elif item["description"] == "1 joint" and (not product.use_joint or not product.price.joint):
-                        logger.warning("Product is currently not available as joint", kind_name=item["kind_name"])
-                    else:
-                        logger.info(
-                            "Found product in order item and in available products",
-                            kind_id=item["kind_id"],
-                            kind_name=item["kind_name"],
-                        )
-                        found_product = True
-                else:
-                    logger.warning("Product is currently not available", kind_name=item["kind_name"])
-            if item.get("product_id") and item["product_id"] == str(product.product_id):
-                if product.active:
-                    if not product.use_piece or not product.price.piece:
-                        logger.warning("Product is currently not available as piece", product_name=item["product_name"])
-                    else:
-                        logger.info(
-                            "Found horeca product in order item and in available products",
-                            product_id=item["product_id"],
-                            product_name=item["product_name"],
-                        )
-                        found_product = True
-                else:
-                    logger.warning("Horeca product is currently not available", product_name=item["product_name"])
-        if not found_product:
-            return item["kind_name"] if item["kind_name"] else item["product_name"]
-    return None
+        priced_item = availability.price(item)
+        if not priced_item:
+            name = item.get("kind_name") or item.get("product_name")
+            logger.warning("Product is currently not available", name=name, description=item.get("description"))
+            unavailable_product_names.append(name)
+            continue
+        total += priced_item.price * item["quantity"]
+        grams += priced_item.grams * item["quantity"]
+    return round(total, 2), round(grams, 2), unavailable_product_names
 
 
 @api.route("/")
@@ -182,7 +249,9 @@ class OrderResourceList(Resource):
         sort = get_sort_from_args(args, "created_at", default_sort_order="DESC")
         filter = get_filter_from_args(args)
 
-        query_result, content_range = query_with_filters(Order, Order.query, range, sort, filter)
+        query_result, content_range = query_with_filters(
+            Order, with_order_names(Order.query), range, sort, filter, count_mode=args["count_mode"]
+        )
         for order in query_result:
             if (order.status == "complete" or order.status == "cancelled") and order.completed_by:
                 order.completed_by_name = order.user.first_name
@@ -193,6 +262,14 @@ class OrderResourceList(Resource):
 
     @api.expect(order_serializer)
     @api.marshal_with(order_response_marshaller)
+    @api.doc(
+        params={
+            "Idempotency-Key": {
+                "in": "header",
+                "description": "Unique key per order: retries with the same key get the response of the first one",
+            }
+        }
+    )
     def post(self):
         """New Order"""
         payload = api.payload
@@ -207,27 +284,55 @@ class OrderResourceList(Resource):
             # allow test table to bypass IP check if any
             abort(400, "NOT_ON_SHOP_WIFI")
 
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            response = get_idempotent_response(shop.id, idempotency_key)
+            if response:
+                logger.info("Replaying order response", idempotency_key=idempotency_key)
+                return response, 201
+
+        total, weight, unavailable_product_names = price_order(payload["order_info"], shop)
+
         # 5 gram check
-        total_cannabis = get_price_rules_total(payload["order_info"])
-        logger.info("Checked order weight", weight=total_cannabis)
-        if total_cannabis > 5:
+        logger.info("Checked order weight", weight=weight)
+        if weight > 5:
             abort(400, "MAX_5_GRAMS_ALLOWED")
 
         # Availability check
-        unavailable_product_name = get_first_unavailable_product_name(payload["order_info"], shop_id)
-        if unavailable_product_name:
-            abort(400, f"{unavailable_product_name}, OUT_OF_STOCK")
-
-        payload["customer_order_id"] = Order.query.filter_by(shop_id=str(shop.id)).count() + 1
+        if unavailable_product_names:
+            abort(
+                400,
+                f"{', '.join(unavailable_product_names)}, OUT_OF_STOCK",
+                unavailable_product_names=unavailable_product_names,
+            )
+
+        # The total is a checksum of the order as the customer saw it
+        if abs(total - (payload.get("total") or 0)) >= 0.01:
+            logger.warning("Order total doesn't match the prices", total=payload.get("total"), expected=total)
+            abort(400, "TOTAL_MISMATCH", total=total)
+        payload["total"] = total
+
+        if idempotency_key:
+            response = claim_idempotency_key(shop.id, idempotency_key)
+            if response:
+                return response, 201
+
+        payload["customer_order_id"] = next_customer_order_id(shop.id)
         payload["status"] = "pending"
         if payload["table_id"] == "0999fbcd-a72b-4cc2-abbe-41ccd466cdaf":
             # Test table -> flag it complete
             payload["status"] = "complete"
             payload["completed_at"] = datetime.datetime.utcnow()
 
-        # Todo: recalculate total and use it as a checksum for the payload
         order_id = str(uuid.uuid4())
         order = Order(id=order_id, **payload)
+        order.lines = order_lines(order, shop)
+        if idempotency_key:
+            db.session.add(order)
+            db.session.flush()
+            OrderIdempotencyKey.query.filter_by(shop_id=shop.id, key=idempotency_key).update(
+                {"order_id": order.id, "response": marshal(order, order_response_marshaller)}
+            )
         save(order)
         if payload["table_id"] == "0999fbcd-a72b-4cc2-abbe-41ccd466cdaf":
             # Test table -> invalidate completed orders
@@ -244,7 +349,9 @@ class OrderResource(Resource):
     @marshal_with(order_serializer_with_shop_names)
     def get(self, id):
         """List Order"""
-        item = load(Order, id)
+        item = Order.query.options(joinedload(Order.shop).load_only("name")).filter_by(id=id).first()
+        if not item:
+            abort(404, f"Record id={id} not found")
         item.shop_name = item.shop.name
         return item, 200
 
@@ -293,21 +400,17 @@ class OrderResource(Resource):
 class PendingOrderResourceList(Resource):
     @roles_accepted("admin", "employee")
     @marshal_with(order_serializer_with_shop_names)
-    @api.doc(parser=parser)
+    @api.doc(parser=shop_order_parser)
     def get(self, shop_id):
         """List Orders"""
-        args = parser.parse_args()
-        range = get_range_from_args(args)
-        sort = get_sort_from_args(args, "created_at", default_sort_order="DESC")
-        filter = get_filter_from_args(args)
-
-        query = Order.query.filter(Order.shop_id == shop_id).filter(Order.status == "pending")
-        query_result, content_range = query_with_filters(Order, query, range, sort, filter)
+        args = shop_order_parser.parse_args()
+        query = with_order_names(Order.query).filter(Order.shop_id == shop_id).filter(Order.status == "pending")
+        query_result, headers = list_shop_orders(query, args)
         for order in query_result:
             if order.table_id:
                 order.table_name = order.table.name
 
-        return query_result, 200, {"Content-Range": content_range}
+        return query_result, 200, headers
 
 
 @api.route("/shop/<shop_id>/complete")
@@ -315,25 +418,62 @@ class PendingOrderResourceList(Resource):
 class CompletedOrderResourceList(Resource):
     @roles_accepted("admin", "employee")
     @marshal_with(order_serializer_with_shop_names)
-    @api.doc(parser=parser)
+    @api.doc(parser=shop_order_parser)
     def get(self, shop_id):
         """List Orders"""
-        args = parser.parse_args()
-        range = get_range_from_args(args)
-        sort = get_sort_from_args(args, "created_at", default_sort_order="DESC")
-        filter = get_filter_from_args(args)
-
-        query = Order.query.filter(Order.shop_id == shop_id).filter(
-            or_(Order.status == "complete", Order.status == "cancelled")
+        args = shop_order_parser.parse_args()
+        query = (
+            with_order_names(Order.query)
+            .filter(Order.shop_id == shop_id)
+            .filter(or_(Order.status == "complete", Order.status == "cancelled"))
         )
-        query_result, content_range = query_with_filters(Order, query, range, sort, filter)
+        query_result, headers = list_shop_orders(query, args)
         for order in query_result:
             if (order.status == "complete" or order.status == "cancelled") and order.completed_by:
                 order.completed_by_name = order.user.first_name
             if order.table_id:
                 order.table_name = order.table.name
 
-        return query_result, 200, {"Content-Range": content_range}
+        return query_result, 200, headers
+
+
+@api.route("/shop/<shop_id>/events")
+@api.doc("Stream of new and changed orders per shop.")
+class OrderEventsResource(Resource):
+    @roles_accepted("admin", "employee")
+    @api.produces(["text/event-stream"])
+    def get(self, shop_id):
+        """Stream Order events
+
+        Server-Sent Events of the orders of a shop as they're committed: `pending_orders` for new orders and
+        `completed_orders` for changed ones. Browsers can pass the token as `auth_token` query parameter.
+        """
+        shop_id = load(Shop, shop_id).id
+        keepalive = current_app.config["ORDER_EVENTS_KEEPALIVE"]
+        # Streams stay open for hours: give the connection back to the pool instead of idling in a transaction
+        db.session.remove()
+
+        def stream(events):
+            try:
+                # Tell the client it's connected, so it can fetch the current lists
+                yield "retry: 3000\n: connected\n\n"
+                while True:
+                    try:
+                        event = events.get(timeout=keepalive)
+                    except queue.Empty:
+                        # Keeps proxies from closing an idle connection
+                        yield ": keepalive\n\n"
+                        continue
+                    yield f"id: {event['order']['id']}\nevent: {event['type']}\ndata: {json.dumps(event['order'])}\n\n"
+            finally:
+                order_event_broker.unsubscribe(shop_id, events)
+
+        response = Response(
+            stream_with_context(stream(order_event_broker.subscribe(shop_id))), mimetype="text/event-stream"
+        )
+        response.cache_control.no_cache = True
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
 
 
 @api.route("/check/<ids>")
@@ -352,16 +492,27 @@ class OrderResource(Resource):
         if len(id_list) > 10:
             abort(400, "Max 10 orders")
 
-        # Build response
-        items = []
-        for id in id_list:
-            item = load(Order, id, allow_404=True)
-            if item:
-                item.table_name = item.table.name
-                items.append(item)
-
-        for item in items:
-            if item.shop_id != items[0].shop_id:
-                abort(400, "All ID's should belong to one shop")
+        # One query for all orders with their table names; the window counts tell if they're of more than one shop
+        rows = (
+            db.session.query(
+                Order.id,
+                Order.customer_order_id,
+                Order.total,
+                Order.status,
+                Order.created_at,
+                Order.completed_at,
+                Order.table_id,
+                Table.name.label("table_name"),
+                func.count().over(partition_by=Order.shop_id).label("shop_orders"),
+                func.count().over().label("orders"),
+            )
+            .outerjoin(Table, Order.table_id == Table.id)
+            .filter(Order.id.in_(id_list))
+            .all()
+        )
+        if any(row.shop_orders != row.orders for row in rows):
+            abort(400, "All ID's should belong to one shop")
 
+        orders = {str(row.id): row._asdict() for row in rows}
+        items = [orders[str(uuid.UUID(id))] for id in id_list if str(uuid.UUID(id)) in orders]
         return items, 200
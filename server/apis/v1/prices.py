@@ -11,6 +11,7 @@ from apis.helpers import (
     save,
     update,
 )
+from apis.totals import COUNT_MODES
 from database import Price
 from flask_restx import Namespace, Resource, fields, marshal_with
 from flask_security import roles_accepted
@@ -40,6 +41,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -56,7 +60,13 @@ class PriceResourceList(Resource):
         filter = get_filter_from_args(args)
 
         query_result, content_range = query_with_filters(
-            Price, Price.query, range, sort, filter, quick_search_columns=["internal_product_id"]
+            Price,
+            Price.query,
+            range,
+            sort,
+            filter,
+            quick_search_columns=["internal_product_id"],
+            count_mode=args["count_mode"],
         )
         return query_result, 200, {"Content-Range": content_range}
 
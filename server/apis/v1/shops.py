@@ -1,70 +1,46 @@
 import uuid
+from datetime import datetime, timedelta
 
 import structlog
 from apis.helpers import (
+    conditional_response,
     delete,
     get_filter_from_args,
     get_range_from_args,
     get_sort_from_args,
+    invalidateShopCache,
     load,
     query_with_filters,
     save,
     update,
 )
-from database import Category, Price, Shop, ShopToPrice
-from flask_restx import Namespace, Resource, abort, fields, marshal_with
+from apis.menu import (
+    MENU_LANGUAGES,
+    MENU_VARIANTS,
+    get_or_rebuild_shop_menu,
+    get_shop_menu,
+    get_shop_menu_changes,
+    menu_encodings,
+    menu_etag,
+    menu_variant,
+    parse_since,
+    price_fields,
+    shop_etag,
+)
+from apis.menu_cache import menu_cache, notify_menu_invalidated
+from apis.sales import get_shop_sales
+from apis.totals import COUNT_MODES
+from database import Category, Shop, ShopToPrice
+from flask import current_app, json
+from flask_restx import Namespace, Resource, abort, fields, inputs, marshal, marshal_with
 from flask_security import roles_accepted
+from sqlalchemy import or_
+from utils import validate_uuid4
 
 logger = structlog.get_logger(__name__)
 
 api = Namespace("shops", description="Shop related operations")
 
-strain_fields = {"name": fields.String}
-
-
-price_fields = {
-    "id": fields.String,
-    "internal_product_id": fields.String,
-    "active": fields.Boolean,
-    "new": fields.Boolean,
-    "category_id": fields.String,
-    "category_name": fields.String,
-    "category_name_en": fields.String,
-    "category_icon": fields.String,
-    "category_color": fields.String,
-    "category_order_number": fields.Integer,
-    "category_image_1": fields.String,
-    "category_image_2": fields.String,
-    "main_category_id": fields.String,
-    "main_category_name": fields.String,
-    "main_category_name_en": fields.String,
-    "main_category_icon": fields.String,
-    "main_category_order_number": fields.Integer,
-    "kind_id": fields.String,
-    "kind_image": fields.String,
-    "strains": fields.Nested(strain_fields),
-    "kind_name": fields.String,
-    "kind_short_description_nl": fields.String,
-    "kind_short_description_en": fields.String,
-    "product_id": fields.String,
-    "product_image": fields.String,
-    "product_name": fields.String,
-    "product_short_description_nl": fields.String,
-    "product_short_description_en": fields.String,
-    "kind_c": fields.Boolean,
-    "kind_h": fields.Boolean,
-    "kind_i": fields.Boolean,
-    "kind_s": fields.Boolean,
-    "half": fields.Float,
-    "one": fields.Float,
-    "two_five": fields.Float,
-    "five": fields.Float,
-    "joint": fields.Float,
-    "piece": fields.Float,
-    "created_at": fields.DateTime,
-    "modified_at": fields.DateTime,
-}
-
 shop_serializer = api.model(
     "Shop",
     {
@@ -74,23 +50,81 @@ shop_serializer = api.model(
     },
 )
 
-shop_serializer_with_prices = {
-    "id": fields.String(),
-    "name": fields.String(required=True, description="Unique Shop"),
-    "description": fields.String(required=True, description="Shop description", default=False),
-    "prices": fields.Nested(price_fields),
+shop_price_changes_fields = {
+    "since": fields.DateTime(description="Changes after this moment are included"),
+    "until": fields.DateTime(description="Moment the changes were collected: use it as `since` for the next request"),
+    "added": fields.Nested(price_fields),
+    "changed": fields.Nested(price_fields),
+    "removed": fields.List(fields.String, description="Ids of removed price rows"),
 }
 
 shop_hash_fields = {"modified_at": fields.DateTime()}
 shop_last_completed_order = {"last_completed_order": fields.String()}
 shop_last_pending_order = {"last_pending_order": fields.String()}
 
+shop_sales_fields = {
+    "day": fields.Date,
+    "kind_id": fields.String,
+    "kind_name": fields.String,
+    "product_id": fields.String,
+    "product_name": fields.String,
+    "quantity": fields.Integer,
+    "grams": fields.Float,
+    "revenue": fields.Float,
+}
+
 ip_serializer = api.model("AllowedIp", {"ip": fields.String(required=True, description="Allowed IP"),},)
 
 parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
+
+menu_parser = api.parser()
+menu_parser.add_argument(
+    "format",
+    location="args",
+    choices=MENU_VARIANTS,
+    default="full",
+    help="full: one flat row per price, compact: lookup tables with rows referencing them, columnar: compact with "
+    "one array per price column",
+)
+
+menu_parser.add_argument(
+    "lang", location="args", choices=MENU_LANGUAGES, help="Only include texts in this language, default: both"
+)
+
+slice_parser = api.parser()
+slice_parser.add_argument(
+    "lang", location="args", choices=MENU_LANGUAGES, help="Only include texts in this language, default: both"
+)
+
+changes_parser = api.parser()
+changes_parser.add_argument(
+    "since", location="args", required=True, help="ISO 8601 timestamp or the ETag of a previously fetched menu"
+)
+
+sales_parser = api.parser()
+sales_parser.add_argument("start", location="args", type=inputs.date, help="First day, e.g. 2021-06-01")
+sales_parser.add_argument("end", location="args", type=inputs.date, help="Last day, e.g. 2021-06-30")
+sales_parser.add_argument("kind_id", location="args", help="Only sales of this kind")
+sales_parser.add_argument("product_id", location="args", help="Only sales of this product")
+
+
+def menu_response(menu, shop_id, variant):
+    """Serve a menu snapshot, building it first when it's missing or stale."""
+    if not menu:
+        menu, stale = get_or_rebuild_shop_menu(
+            shop_id, variant, stale_while_revalidate=current_app.config["MENU_STALE_WHILE_REVALIDATE"]
+        )
+        if not menu:
+            abort(404, f"Record id={shop_id} not found")
+        if not stale:
+            menu_cache.put(menu)
+    return conditional_response(menu.payload, menu_etag(menu), menu.created_at, encodings=menu_encodings(menu))
 
 
 @api.route("/allowed-ips/<id>")
@@ -146,7 +180,9 @@ class ShopResourceList(Resource):
         sort = get_sort_from_args(args)
         filter = get_filter_from_args(args)
 
-        query_result, content_range = query_with_filters(Shop, Shop.query, range, sort, filter)
+        query_result, content_range = query_with_filters(
+            Shop, Shop.query, range, sort, filter, count_mode=args["count_mode"]
+        )
         return query_result, 200, {"Content-Range": content_range}
 
     @roles_accepted("admin")
@@ -162,11 +198,21 @@ class ShopResourceList(Resource):
 @api.route("/cache-status/<id>")
 @api.doc("Shop cache status so clients can determine if the cash should be invalidated.")
 class ShopCacheResource(Resource):
-    @marshal_with(shop_hash_fields)
+    @api.response(304, "Not modified")
     def get(self, id):
         """Show date of last change in data that could be visible in this shop"""
         item = load(Shop, id)
-        return item, 200
+        payload = json.dumps(marshal(item, shop_hash_fields))
+        return conditional_response(payload, shop_etag(item.modified_at), item.modified_at)
+
+
+@api.route("/menu-cache")
+@api.doc("Statistics of the menu cache of the worker that handles the request.")
+class ShopMenuCacheResource(Resource):
+    @roles_accepted("admin")
+    def get(self):
+        """Show menu cache statistics"""
+        return menu_cache.stats(), 200
 
 
 @api.route("/last-completed-order/<id>")
@@ -189,68 +235,98 @@ class ShopLastPendingOrderResource(Resource):
         return item, 200
 
 
+@api.route("/<id>/prices/changes")
+@api.doc("Price rows of a shop that were added, changed or removed since a moment, to patch a cached menu.")
+class ShopPriceChangesResource(Resource):
+    @marshal_with(shop_price_changes_fields)
+    @api.doc(parser=changes_parser)
+    def get(self, id):
+        """List menu changes
+
+        Rows changed shortly before `since` are included again, clients apply the changes idempotently.
+        """
+        args = changes_parser.parse_args()
+        try:
+            since = parse_since(args["since"])
+        except ValueError:
+            abort(400, "since should be an ISO 8601 timestamp or a menu ETag")
+        if since < datetime.utcnow() - timedelta(days=current_app.config["MENU_TOMBSTONES_DAYS"]):
+            abort(410, "Removed price rows aren't kept that long: fetch the full menu")
+        item = load(Shop, id)
+        margin = timedelta(seconds=current_app.config["MENU_CHANGES_MARGIN"])
+        return get_shop_menu_changes(item.id, since, margin), 200
+
+
+@api.route("/<id>/sales")
+@api.doc("Daily sales of completed orders per kind and product of a shop.")
+class ShopSalesResource(Resource):
+    @roles_accepted("admin")
+    @marshal_with(shop_sales_fields)
+    @api.doc(parser=sales_parser)
+    def get(self, id):
+        """List daily sales
+
+        Sales are rolled up from the orders periodically by `flask roll-up-sales`, recent orders and changes can be
+        missing. Days are calendar days in the `SALES_TIMEZONE` of the app.
+        """
+        args = sales_parser.parse_args()
+        for key in ("kind_id", "product_id"):
+            if args[key] and not validate_uuid4(args[key]):
+                abort(400, f"{key} is not valid")
+        item = load(Shop, id)
+        return get_shop_sales(item.id, args["start"], args["end"], args["kind_id"], args["product_id"]), 200
+
+
+@api.route("/<id>/categories/<category_id>")
+@api.doc("Price rows of one category of a shop, e.g. for a category QR code landing page.")
+class ShopCategoryResource(Resource):
+    @api.response(304, "Not modified")
+    @api.doc(parser=slice_parser)
+    def get(self, id, category_id):
+        """List Shop Category"""
+        args = slice_parser.parse_args()
+        variant = menu_variant(lang=args["lang"], category_id=category_id)
+        menu = get_shop_menu(id, variant)
+        if not menu:
+            # Only build snapshots for existing categories
+            if not validate_uuid4(category_id) or not Category.query.filter_by(id=category_id, shop_id=id).first():
+                abort(404, f"Record id={category_id} not found")
+        return menu_response(menu, id, variant)
+
+
+@api.route("/<id>/categories/<category_id>/products/<product_id>")
+@api.doc("Price rows of one kind or product in a category of a shop, e.g. for a product QR code landing page.")
+class ShopCategoryProductResource(Resource):
+    @api.response(304, "Not modified")
+    @api.doc(parser=slice_parser)
+    def get(self, id, category_id, product_id):
+        """List Shop Category Product"""
+        args = slice_parser.parse_args()
+        variant = menu_variant(lang=args["lang"], category_id=category_id, item_id=product_id)
+        menu = get_shop_menu(id, variant)
+        if not menu:
+            # Only build snapshots for kinds or products that are in the category
+            if (
+                not validate_uuid4(category_id)
+                or not validate_uuid4(product_id)
+                or not ShopToPrice.query.filter_by(shop_id=id, category_id=category_id)
+                .filter(or_(ShopToPrice.kind_id == product_id, ShopToPrice.product_id == product_id))
+                .first()
+            ):
+                abort(404, f"Record id={product_id} not found")
+        return menu_response(menu, id, variant)
+
+
 @api.route("/<id>")
 @api.doc("Shop detail operations.")
 class ShopResource(Resource):
-    @marshal_with(shop_serializer_with_prices)
+    @api.response(304, "Not modified")
+    @api.doc(parser=menu_parser)
     def get(self, id):
         """List Shop"""
-        item = load(Shop, id)
-        price_relations = (
-            ShopToPrice.query.filter_by(shop_id=item.id)
-            .join(ShopToPrice.price)
-            .join(ShopToPrice.category)
-            .order_by(Category.name, Price.piece, Price.joint, Price.one, Price.five, Price.half, Price.two_five)
-            .all()
-        )
-        item.prices = [
-            {
-                "id": pr.id,
-                "internal_product_id": pr.price.internal_product_id,
-                "active": pr.active,
-                "new": pr.new,
-                "category_id": pr.category_id,
-                "category_name": pr.category.name,
-                "category_name_en": pr.category.name_en,
-                "category_icon": pr.category.icon,
-                "category_color": pr.category.color,
-                "category_order_number": pr.category.order_number,
-                "category_image_1": pr.category.image_1,
-                "category_image_2": pr.category.image_2,
-                "main_category_id": pr.category.main_category.id if pr.category.main_category else "Unknown",
-                "main_category_name": pr.category.main_category.name if pr.category.main_category else "Unknown",
-                "main_category_name_en": pr.category.main_category.name_en if pr.category.main_category else "Unknown",
-                "main_category_icon": pr.category.main_category.icon if pr.category.main_category else "Unknown",
-                "main_category_order_number": pr.category.main_category.order_number
-                if pr.category.main_category
-                else 0,
-                "kind_id": pr.kind_id,
-                "kind_image": pr.kind.image_1 if pr.kind_id else None,
-                "kind_name": pr.kind.name if pr.kind_id else None,
-                "strains": [strain.strain for strain in pr.kind.kind_to_strains] if pr.kind_id else [],
-                "kind_short_description_nl": pr.kind.short_description_nl if pr.kind_id else None,
-                "kind_short_description_en": pr.kind.short_description_en if pr.kind_id else None,
-                "kind_c": pr.kind.c if pr.kind_id else None,
-                "kind_h": pr.kind.h if pr.kind_id else None,
-                "kind_i": pr.kind.i if pr.kind_id else None,
-                "kind_s": pr.kind.s if pr.kind_id else None,
-                "product_id": pr.product_id,
-                "product_image": pr.product.image_1 if pr.product_id else None,
-                "product_name": pr.product.name if pr.product_id else None,
-                "product_short_description_nl": pr.product.short_description_nl if pr.product_id else None,
-                "product_short_description_en": pr.product.short_description_en if pr.product_id else None,
-                "half": pr.price.half if pr.use_half else None,
-                "one": pr.price.one if pr.use_one else None,
-                "two_five": pr.price.two_five if pr.use_two_five else None,
-                "five": pr.price.five if pr.use_five else None,
-                "joint": pr.price.joint if pr.use_joint else None,
-                "piece": pr.price.piece if pr.use_piece else None,
-                "created_at": pr.created_at,
-                "modified_at": pr.modified_at,
-            }
-            for pr in price_relations
-        ]
-        return item, 200
+        args = menu_parser.parse_args()
+        variant = menu_variant(args["format"], args["lang"])
+        return menu_response(get_shop_menu(id, variant), id, variant)
 
     @roles_accepted("admin")
     @api.expect(shop_serializer)
@@ -259,11 +335,15 @@ class ShopResource(Resource):
         """Edit Shop"""
         item = load(Shop, id)
         item = update(item, api.payload)
+        # The shop name and description are part of the menu
+        invalidateShopCache(item.id)
         return item, 201
 
     @roles_accepted("admin")
     def delete(self, id):
         """Delete Shop"""
         item = load(Shop, id)
+        shop_id = item.id
         delete(item)
+        notify_menu_invalidated(shop_id)
         return "", 204
@@ -11,6 +11,7 @@ from apis.helpers import (
     save,
     update,
 )
+from apis.totals import COUNT_MODES
 from database import Category, Kind, Price, Product, Shop, ShopToPrice, db
 from flask_restx import Namespace, Resource, abort, fields, marshal_with
 from flask_security import roles_accepted
@@ -77,6 +78,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -94,7 +98,9 @@ class ShopsToPricesResourceList(Resource):
 
         query = ShopToPrice.query.join(ShopToPrice.price).options(contains_eager(ShopToPrice.price), defer("price_id"))
 
-        query_result, content_range = query_with_filters(ShopToPrice, query, range, sort, filter)
+        query_result, content_range = query_with_filters(
+            ShopToPrice, query, range, sort, filter, count_mode=args["count_mode"]
+        )
 
         for result in query_result:
             result.half = result.price.half if result.price.half and result.use_half else None
@@ -214,16 +220,21 @@ class ShopToPriceResource(Resource):
             abort(400, "One Cannabis or one Horeca product has to be provided")
 
         # Ok we survived all that: let's save it:
+        previous_shop_id = item.shop_id
         item = update(item, api.payload)
         invalidateShopCache(item.shop_id)
+        if previous_shop_id != item.shop_id:
+            # Moved to another shop: it's gone from the menu of the previous one
+            invalidateShopCache(previous_shop_id)
         return item, 201
 
     @roles_accepted("admin", "employee")
     def delete(self, id):
         """Delete ShopToPrice"""
         item = load(ShopToPrice, id)
-        invalidateShopCache(item.shop_id)
+        shop_id = item.shop_id
         delete(item)
+        invalidateShopCache(shop_id)
         return "", 204
 
 
@@ -11,6 +11,7 @@ from apis.helpers import (
     save,
     update,
 )
+from apis.totals import COUNT_MODES
 from database import Strain
 from flask_restx import Namespace, Resource, fields, marshal_with
 from flask_security import roles_accepted
@@ -27,6 +28,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -42,7 +46,9 @@ class StrainResourceList(Resource):
         sort = get_sort_from_args(args)
         filter = get_filter_from_args(args)
 
-        query_result, content_range = query_with_filters(Strain, Strain.query, range, sort, filter)
+        query_result, content_range = query_with_filters(
+            Strain, Strain.query, range, sort, filter, count_mode=args["count_mode"]
+        )
         return query_result, 200, {"Content-Range": content_range}
 
     @roles_accepted("admin", "employee")
@@ -1,5 +1,6 @@
 import structlog
 from apis.helpers import get_filter_from_args, get_range_from_args, get_sort_from_args, query_with_filters
+from apis.totals import COUNT_MODES
 from database import User
 from flask_login import current_user
 from flask_restx import Namespace, Resource, abort, fields, marshal_with
@@ -27,6 +28,9 @@ parser = api.parser()
 parser.add_argument("range", location="args", help="Pagination: default=[0,19]")
 parser.add_argument("sort", location="args", help='Sort: default=["name","ASC"]')
 parser.add_argument("filter", location="args", help="Filter default=[]")
+parser.add_argument(
+    "count_mode", location="args", choices=COUNT_MODES, help="Total: exact, windowed, estimated or none"
+)
 
 
 @api.route("/")
@@ -42,7 +46,13 @@ class UserResourceList(Resource):
         filter = get_filter_from_args(args)
 
         query_result, content_range = query_with_filters(
-            User, User.query, range, sort, filter, quick_search_columns=["username", "email"]
+            User,
+            User.query,
+            range,
+            sort,
+            filter,
+            quick_search_columns=["username", "email"],
+            count_mode=args["count_mode"],
         )
         return query_result, 200, {"Content-Range": content_range}
 
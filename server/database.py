@@ -3,13 +3,43 @@ from datetime import datetime
 
 from flask_security import RoleMixin, SQLAlchemySessionUserDatastore, UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import JSON, Boolean, Column, DateTime, Float, ForeignKey, Integer, String
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    Column,
+    Computed,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+    event,
+    inspect,
+    text,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
 from sqlalchemy.orm import backref, relationship
 
 db = SQLAlchemy()
 
 
+def search_vector_column(*weighted_columns):
+    """Generated tsvector of text columns, given as (column, weight) pairs, for the quick search of admin lists.
+
+    Besides the GIN index on the vector, the migration adds pg_trgm indexes for substring search on the columns. Those
+    aren't declared on the models, so `create_all` works without the extension.
+    """
+    vectors = [
+        f"setweight(to_tsvector('simple'::regconfig, coalesce({column}, '')), '{weight}')"
+        for column, weight in weighted_columns
+    ]
+    return Column(TSVECTOR, Computed(" || ".join(vectors), persisted=True))
+
+
 class RolesUsers(db.Model):
     __tablename__ = "roles_users"
     id = Column(Integer(), primary_key=True)
@@ -34,6 +64,7 @@ class Role(db.Model, RoleMixin):
 
 class User(db.Model, UserMixin):
     __tablename__ = "user"
+    __table_args__ = (Index("ix_user_search_vector", "search_vector", postgresql_using="gin"),)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     email = Column(String(255), unique=True)
     first_name = Column(String(255), index=True)
@@ -47,6 +78,7 @@ class User(db.Model, UserMixin):
     roles = relationship("Role", secondary="roles_users", backref=backref("users", lazy="dynamic"))
 
     mail_offers = Column(Boolean, default=False)
+    search_vector = search_vector_column(("username", "A"), ("email", "A"))
 
     # Human-readable values for the User when editing user related stuff.
     def __str__(self):
@@ -89,7 +121,10 @@ class Shop(db.Model):
 
     shops_to_price = relationship("ShopToPrice", cascade="save-update, merge, delete")
     shop_to_category = relationship("Category", cascade="save-update, merge, delete")
-    modified_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow())
+    shop_menus = relationship("ShopMenu", cascade="save-update, merge, delete")
+    # Last change of data that's visible in the shop, set by `invalidateShopCache` and by every flush that changes the
+    # menu of the shop (see apis.shop_changes): order bookkeeping isn't
+    modified_at = Column(DateTime, default=datetime.utcnow)
     last_pending_order = Column(String(255), unique=True)  # order id of last pending order for this shop (UUID)
     last_completed_order = Column(String(255), unique=True)  # order id of last completed order for this shop (UUID)
     allowed_ips = Column(JSON)
@@ -152,6 +187,7 @@ class Category(db.Model):
 
 class Kind(db.Model):
     __tablename__ = "kinds"
+    __table_args__ = (Index("ix_kinds_search_vector", "search_vector", postgresql_using="gin"),)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     name = Column(String(255), unique=True, index=True)
     short_description_nl = Column(String())
@@ -184,6 +220,7 @@ class Kind(db.Model):
 
     kind_strains = relationship("Strain", secondary="kinds_to_strains")
     kind_to_strains = relationship("KindToStrain", cascade="save-update, merge, delete")
+    search_vector = search_vector_column(("name", "A"), ("short_description_nl", "B"), ("short_description_en", "B"))
 
     def __repr__(self):
         return "<Kinds %r, id:%s>" % (self.name, self.id)
@@ -191,6 +228,7 @@ class Kind(db.Model):
 
 class Price(db.Model):
     __tablename__ = "prices"
+    __table_args__ = (Index("ix_prices_search_vector", "search_vector", postgresql_using="gin"),)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     internal_product_id = Column("internal_product_id", String(), unique=True)
     half = Column("half", Float(), nullable=True)
@@ -199,6 +237,7 @@ class Price(db.Model):
     five = Column("five", Float(), nullable=True)
     joint = Column("joint", Float(), nullable=True)
     piece = Column("piece", Float(), nullable=True)
+    search_vector = search_vector_column(("internal_product_id", "A"))
 
     def __repr__(self):
         return f"Price for product_id: {self.internal_product_id}"
@@ -206,6 +245,7 @@ class Price(db.Model):
 
 class Order(db.Model):
     __tablename__ = "orders"
+    __table_args__ = (Index("ix_orders_shop_id_status_created_at", "shop_id", "status", "created_at"),)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     customer_order_id = Column(Integer)
     notes = Column(String, nullable=True)
@@ -226,6 +266,78 @@ class Order(db.Model):
         return "<Order for shop: %s with total: %s>" % (self.shop.name, self.total)
 
 
+class ShopOrderCounter(db.Model):
+    """Last customer order id handed out per shop, incremented in the transaction that inserts the order."""
+
+    __tablename__ = "shop_order_counters"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id", ondelete="CASCADE"), unique=True, index=True)
+    last_customer_order_id = Column(Integer, default=0, nullable=False)
+
+
+class OrderIdempotencyKey(db.Model):
+    """Response to an order submission, replayed to retries with the same Idempotency-Key header."""
+
+    __tablename__ = "order_idempotency_keys"
+    __table_args__ = (Index("ix_order_idempotency_keys_shop_id_key", "shop_id", "key", unique=True),)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id", ondelete="CASCADE"))
+    key = Column(String(255), nullable=False)
+    order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id", ondelete="CASCADE"), nullable=True)
+    response = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class OrderLine(db.Model):
+    """An item of an order, written with the order so sales can be aggregated in SQL instead of from `order_info`.
+
+    Kinds and products aren't foreign keys: lines keep the history of kinds and products that were deleted since.
+    Lines of deleted orders and replaced lines lose their order, `roll_up_sales` deletes them after correcting the sales.
+    """
+
+    __tablename__ = "order_lines"
+    __table_args__ = (
+        Index(
+            "ix_order_lines_not_rolled_up",
+            "created_at",
+            postgresql_where=text("rolled_up_at IS NULL OR order_id IS NULL"),
+        ),
+        Index("ix_order_lines_shop_id_created_at", "shop_id", "created_at"),
+    )
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id", ondelete="SET NULL"), index=True)
+    shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id", ondelete="CASCADE"))
+    kind_id = Column(UUID(as_uuid=True), nullable=True)
+    product_id = Column(UUID(as_uuid=True), nullable=True)
+    description = Column(String(255))
+    price = Column(Float())
+    quantity = Column(Integer)
+    grams = Column(Float(), default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set when the sales of the day of the line are recomputed, cleared when its order changes
+    rolled_up_at = Column(DateTime, nullable=True)
+
+    order = db.relationship("Order", backref=backref("lines", cascade="save-update, merge", passive_deletes="all"))
+
+
+class ShopSalesDaily(db.Model):
+    """Sales per shop, day and kind or product of completed orders, recomputed per day from the order lines."""
+
+    __tablename__ = "shop_sales_daily"
+    __table_args__ = (Index("ix_shop_sales_daily_shop_id_day_item_id", "shop_id", "day", "item_id", unique=True),)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    shop_id = Column(UUID(as_uuid=True), ForeignKey("shops.id", ondelete="CASCADE"), nullable=False)
+    day = Column(Date, nullable=False)
+    # The kind or product id
+    item_id = Column(UUID(as_uuid=True), nullable=False)
+    kind_id = Column(UUID(as_uuid=True), nullable=True)
+    product_id = Column(UUID(as_uuid=True), nullable=True)
+    quantity = Column(Integer, default=0, nullable=False)
+    grams = Column(Float(), default=0, nullable=False)
+    revenue = Column(Float(), default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
 # Tag many to many relations
 class KindToTag(db.Model):
     __tablename__ = "kinds_to_tags"
@@ -264,6 +376,7 @@ class KindToStrain(db.Model):
 
 class Product(db.Model):
     __tablename__ = "products"
+    __table_args__ = (Index("ix_products_search_vector", "search_vector", postgresql_using="gin"),)
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     name = Column(String(255), index=True)
     short_description_nl = Column(String())
@@ -283,12 +396,17 @@ class Product(db.Model):
     image_4 = Column(String(255), unique=True, index=True)
     image_5 = Column(String(255), unique=True, index=True)
     image_6 = Column(String(255), unique=True, index=True)
+    search_vector = search_vector_column(("name", "A"), ("short_description_nl", "B"), ("short_description_en", "B"))
 
     shop_to_price = relationship("ShopToPrice", cascade="save-update, merge, delete")
 
 
 class ShopToPrice(db.Model):
     __tablename__ = "shops_to_price"
+    __table_args__ = (
+        Index("ix_shops_to_price_shop_id_modified_at", "shop_id", "modified_at"),
+        Index("ix_shops_to_price_shop_id_category_id_order_number", "shop_id", "category_id", "order_number"),
+    )
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     active = Column("active", Boolean(), default=True)
     new = Column("new", Boolean(), default=False)
@@ -315,6 +433,59 @@ class ShopToPrice(db.Model):
     modified_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class ShopToPriceTombstone(db.Model):
+    """Remembers deleted price relations, so clients that patch their menu can remove them too."""
+
+    __tablename__ = "shops_to_price_tombstones"
+    __table_args__ = (Index("ix_shops_to_price_tombstones_shop_id_deleted_at", "shop_id", "deleted_at"),)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    shop_id = Column("shop_id", UUID(as_uuid=True), ForeignKey("shops.id", ondelete="CASCADE"))
+    shop_to_price_id = Column("shop_to_price_id", UUID(as_uuid=True))
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+
+def insert_shop_to_price_tombstone(connection, shop_id, shop_to_price_id):
+    connection.execute(
+        ShopToPriceTombstone.__table__.insert().values(
+            id=uuid.uuid4(), shop_id=shop_id, shop_to_price_id=shop_to_price_id, deleted_at=datetime.utcnow()
+        )
+    )
+
+
+@event.listens_for(ShopToPrice, "after_delete")
+def add_shop_to_price_tombstone(mapper, connection, target):
+    # Also catches the relations that are removed by a cascade, e.g. when deleting a kind or a product
+    insert_shop_to_price_tombstone(connection, target.shop_id, target.id)
+
+
+@event.listens_for(ShopToPrice, "after_update")
+def add_moved_shop_to_price_tombstone(mapper, connection, target):
+    # A relation that's moved to another shop is removed from the menu of the previous one
+    for shop_id in inspect(target).attrs.shop_id.history.deleted:
+        if shop_id is not None and shop_id != target.shop_id:
+            insert_shop_to_price_tombstone(connection, shop_id, target.id)
+
+
+class ShopMenu(db.Model):
+    """Precompiled price list of a shop, serialized as it is served by the shop detail endpoint.
+
+    A shop has one snapshot per variant of the menu, e.g. the full or the compact format.
+    """
+
+    __tablename__ = "shop_menus"
+    __table_args__ = (Index("ix_shop_menus_shop_id_variant", "shop_id", "variant", unique=True),)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    shop_id = Column("shop_id", UUID(as_uuid=True), ForeignKey("shops.id"), index=True)
+    shop = db.relationship("Shop", lazy=True)
+    variant = Column(String(255), default="full", nullable=False)
+    version = Column(Integer, default=1, nullable=False)
+    shop_modified_at = Column(DateTime)  # the Shop.modified_at this snapshot was built from
+    payload = Column(Text)
+    payload_gzip = Column(LargeBinary)
+    payload_br = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.utcnow)  # start of the build, price changes after it aren't in it
+
+
 class Strain(db.Model):
     __tablename__ = "strains"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
@@ -1,6 +1,7 @@
 import io
 import os
 import traceback
+from datetime import timedelta
 from functools import wraps
 from http import HTTPStatus
 from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union, cast
@@ -19,6 +20,12 @@ from admin_views import (
     UserAdminView,
 )
 from apis import api
+from apis.menu import purge_menu_tombstones
+from apis.menu_cache import start_menu_cache
+from apis.order_events import start_order_event_broker
+from apis.sales import roll_up_sales, track_order_changes
+from apis.shop_changes import track_shop_changes
+from apis.v1.orders import purge_idempotency_keys
 from database import (
     Category,
     Flavor,
@@ -64,7 +71,8 @@ CORS(
     resources="/*",
     allow_headers="*",
     origins="*",
-    expose_headers="Authorization,Content-Type,Authentication-Token,Content-Range",
+    expose_headers="Authorization,Content-Type,Authentication-Token,Content-Range,ETag,Last-Modified,X-Next-Cursor,"
+    "X-Total-Count",
 )
 DATABASE_URI = os.getenv("DATABASE_URI", "postgres://postgres:@localhost/pricelist-test")  # setup Travis
 
@@ -111,6 +119,36 @@ app.config["WTF_CSRF_ENABLED"] = False
 # The S3 Bucket for file storage. Note: IMAGE_S3_ACCESS_KEY_ID and IMAGE_S3_SECRET_ACCESS_KEY are also needed!
 app.config["IMAGE_BUCKET"] = os.getenv("IMAGE_S3_BUCKET") if os.getenv("IMAGE_S3_BUCKET") else "image-prijslijst.info"
 
+# Per worker cache of serialized shop menus, in bytes: 0 disables it. Needs a DB connection per worker to LISTEN for
+# invalidations, so only enable it for long running workers.
+app.config["MENU_CACHE_MAX_BYTES"] = int(os.getenv("MENU_CACHE_MAX_BYTES")) if os.getenv("MENU_CACHE_MAX_BYTES") else 0
+
+# Serve the previous menu snapshot while another request rebuilds it, instead of waiting for the rebuild
+app.config["MENU_STALE_WHILE_REVALIDATE"] = True if os.getenv("MENU_STALE_WHILE_REVALIDATE") else False
+
+# Seconds before `since` that menu deltas look back, for changes of transactions that were running at the last request
+app.config["MENU_CHANGES_MARGIN"] = int(os.getenv("MENU_CHANGES_MARGIN")) if os.getenv("MENU_CHANGES_MARGIN") else 60
+# Days removed price rows are remembered for menu deltas, purged by `flask purge-menu-tombstones`
+app.config["MENU_TOMBSTONES_DAYS"] = int(os.getenv("MENU_TOMBSTONES_DAYS")) if os.getenv("MENU_TOMBSTONES_DAYS") else 30
+
+# Seconds an Idempotency-Key of an order submission is remembered
+app.config["ORDER_IDEMPOTENCY_TTL"] = (
+    int(os.getenv("ORDER_IDEMPOTENCY_TTL")) if os.getenv("ORDER_IDEMPOTENCY_TTL") else 24 * 60 * 60
+)
+
+# Order events for the SSE streams: "local" only reaches streams served by the same worker, "postgres" all of them
+app.config["ORDER_EVENTS_BROKER"] = os.getenv("ORDER_EVENTS_BROKER") if os.getenv("ORDER_EVENTS_BROKER") else "local"
+# Seconds between keepalive comments on an idle order event stream
+app.config["ORDER_EVENTS_KEEPALIVE"] = 15
+
+# Timezone of the days of the sales rollups
+app.config["SALES_TIMEZONE"] = os.getenv("SALES_TIMEZONE") if os.getenv("SALES_TIMEZONE") else "Europe/Amsterdam"
+
+# How list requests count their total when they don't pass `count_mode`: exact, windowed, estimated or none
+app.config["LIST_COUNT_MODE"] = os.getenv("LIST_COUNT_MODE") if os.getenv("LIST_COUNT_MODE") else "exact"
+# Seconds an exact total of a list request is reused, 0 disables it
+app.config["LIST_TOTALS_TTL"] = int(os.getenv("LIST_TOTALS_TTL")) if os.getenv("LIST_TOTALS_TTL") else 0
+
 # Setup Flask-Security with extended user registration
 security = Security(
     app, user_datastore, register_form=ExtendedRegisterForm, confirm_register_form=ExtendedJSONRegisterForm
@@ -127,6 +165,22 @@ def import_prices_click(file):
     import_prices(file)
 
 
+@app.cli.command("roll-up-sales")
+@click.option("--batch-size", default=1000, help="Order lines per transaction")
+def roll_up_sales_click(batch_size):
+    roll_up_sales(batch_size)
+
+
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys_click():
+    purge_idempotency_keys()
+
+
+@app.cli.command("purge-menu-tombstones")
+def purge_menu_tombstones_click():
+    purge_menu_tombstones(timedelta(days=app.config["MENU_TOMBSTONES_DAYS"]))
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db.session.remove()
@@ -385,6 +439,10 @@ def get_my_ip():
 api.init_app(app)
 db.init_app(app)
 mail.init_app(app)
+start_menu_cache(app)
+start_order_event_broker(app)
+track_shop_changes()
+track_order_changes()
 admin.add_view(ShopAdminView(Shop, db.session))
 admin.add_view(OrderAdminView(Order, db.session))
 admin.add_view(BaseAdminView(MainCategory, db.session))
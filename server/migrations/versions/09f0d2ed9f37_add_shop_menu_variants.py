@@ -0,0 +1,31 @@
+"""add shop menu variants
+
+Revision ID: 09f0d2ed9f37
+Revises: 8a687eb535cf
+Create Date: 2026-10-17 20:58:44.913120
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "09f0d2ed9f37"
+down_revision = "8a687eb535cf"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("shop_menus", sa.Column("variant", sa.String(length=255), server_default="full", nullable=False))
+    op.alter_column("shop_menus", "variant", server_default=None)
+    op.drop_index("ix_shop_menus_shop_id", table_name="shop_menus")
+    op.create_index(op.f("ix_shop_menus_shop_id"), "shop_menus", ["shop_id"], unique=False)
+    op.create_index("ix_shop_menus_shop_id_variant", "shop_menus", ["shop_id", "variant"], unique=True)
+
+
+def downgrade():
+    op.execute("DELETE FROM shop_menus WHERE variant != 'full'")
+    op.drop_index("ix_shop_menus_shop_id_variant", table_name="shop_menus")
+    op.drop_index(op.f("ix_shop_menus_shop_id"), table_name="shop_menus")
+    op.create_index("ix_shop_menus_shop_id", "shop_menus", ["shop_id"], unique=True)
+    op.drop_column("shop_menus", "variant")
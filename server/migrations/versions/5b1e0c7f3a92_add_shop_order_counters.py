@@ -0,0 +1,53 @@
+"""add shop order counters
+
+Revision ID: 5b1e0c7f3a92
+Revises: dace52ad2481
+Create Date: 2026-10-17 22:02:41.118305
+
+"""
+import uuid
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "5b1e0c7f3a92"
+down_revision = "dace52ad2481"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "shop_order_counters",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("last_customer_order_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_shop_order_counters_id"), "shop_order_counters", ["id"], unique=False)
+    op.create_index(op.f("ix_shop_order_counters_shop_id"), "shop_order_counters", ["shop_id"], unique=True)
+
+    # Continue after the highest customer order id that was handed out per shop
+    conn = op.get_bind()
+    counters = conn.execute(
+        sa.text("SELECT shop_id, MAX(customer_order_id) FROM orders WHERE shop_id IS NOT NULL GROUP BY shop_id")
+    ).fetchall()
+    for shop_id, last_customer_order_id in counters:
+        conn.execute(
+            sa.text(
+                "INSERT INTO shop_order_counters (id, shop_id, last_customer_order_id) "
+                "VALUES (:id, :shop_id, :last_customer_order_id)"
+            ),
+            id=str(uuid.uuid4()),
+            shop_id=str(shop_id),
+            last_customer_order_id=last_customer_order_id or 0,
+        )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_shop_order_counters_shop_id"), table_name="shop_order_counters")
+    op.drop_index(op.f("ix_shop_order_counters_id"), table_name="shop_order_counters")
+    op.drop_table("shop_order_counters")
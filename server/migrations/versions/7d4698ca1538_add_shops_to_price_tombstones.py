@@ -0,0 +1,43 @@
+"""add shops to price tombstones
+
+Revision ID: 7d4698ca1538
+Revises: 977a93975f12
+Create Date: 2026-10-17 20:02:41.118307
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "7d4698ca1538"
+down_revision = "977a93975f12"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "shops_to_price_tombstones",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("shop_to_price_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("deleted_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_shops_to_price_tombstones_id"), "shops_to_price_tombstones", ["id"], unique=False)
+    op.create_index(
+        "ix_shops_to_price_tombstones_shop_id_deleted_at",
+        "shops_to_price_tombstones",
+        ["shop_id", "deleted_at"],
+        unique=False,
+    )
+    op.create_index("ix_shops_to_price_shop_id_modified_at", "shops_to_price", ["shop_id", "modified_at"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_shops_to_price_shop_id_modified_at", table_name="shops_to_price")
+    op.drop_index("ix_shops_to_price_tombstones_shop_id_deleted_at", table_name="shops_to_price_tombstones")
+    op.drop_index(op.f("ix_shops_to_price_tombstones_id"), table_name="shops_to_price_tombstones")
+    op.drop_table("shops_to_price_tombstones")
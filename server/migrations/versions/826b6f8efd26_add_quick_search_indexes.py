@@ -0,0 +1,71 @@
+"""add quick search vectors and indexes
+
+Revision ID: 826b6f8efd26
+Revises: 922bc5704969
+Create Date: 2026-10-18 00:31:47.902114
+
+"""
+import logging
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "826b6f8efd26"
+down_revision = "922bc5704969"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+# Quick search columns per table, with their weight in the search vector
+SEARCH_COLUMNS = {
+    "kinds": [("name", "A"), ("short_description_nl", "B"), ("short_description_en", "B")],
+    "products": [("name", "A"), ("short_description_nl", "B"), ("short_description_en", "B")],
+    "user": [("username", "A"), ("email", "A")],
+    "prices": [("internal_product_id", "A")],
+}
+
+
+def search_vector(columns):
+    return " || ".join(
+        f"setweight(to_tsvector('simple'::regconfig, coalesce({column}, '')), '{weight}')" for column, weight in columns
+    )
+
+
+def upgrade():
+    # Rewrites the tables once, they're small compared to orders
+    for table, columns in SEARCH_COLUMNS.items():
+        computed = sa.Computed(search_vector(columns), persisted=True)
+        op.add_column(table, sa.Column("search_vector", postgresql.TSVECTOR(), computed))
+
+    # Indexes are built without locking out writes, which can't be done in a transaction
+    with op.get_context().autocommit_block():
+        for table in SEARCH_COLUMNS:
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search_vector "
+                f'ON "{table}" USING gin (search_vector)'
+            )
+
+        conn = op.get_bind()
+        if not conn.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar():
+            logger.warning("pg_trgm isn't available: substring search on the quick search columns won't be indexed")
+            return
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for table, columns in SEARCH_COLUMNS.items():
+            for column, _ in columns:
+                op.execute(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_{column}_trgm "
+                    f'ON "{table}" USING gin ({column} gin_trgm_ops)'
+                )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, columns in SEARCH_COLUMNS.items():
+            for column, _ in columns:
+                op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_{column}_trgm")
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search_vector")
+    for table in SEARCH_COLUMNS:
+        op.drop_column(table, "search_vector")
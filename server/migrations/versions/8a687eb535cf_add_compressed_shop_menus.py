@@ -0,0 +1,25 @@
+"""add compressed shop menu payloads
+
+Revision ID: 8a687eb535cf
+Revises: 7d4698ca1538
+Create Date: 2026-10-17 20:31:05.402611
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8a687eb535cf"
+down_revision = "7d4698ca1538"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("shop_menus", sa.Column("payload_gzip", sa.LargeBinary(), nullable=True))
+    op.add_column("shop_menus", sa.Column("payload_br", sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("shop_menus", "payload_br")
+    op.drop_column("shop_menus", "payload_gzip")
@@ -0,0 +1,122 @@
+"""add order lines and daily sales rollups
+
+Revision ID: 922bc5704969
+Revises: e2a9c3f18b47
+Create Date: 2026-10-17 23:48:10.513062
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "922bc5704969"
+down_revision = "e2a9c3f18b47"
+branch_labels = None
+depends_on = None
+
+UUID_PATTERN = "^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+
+
+def upgrade():
+    op.create_table(
+        "order_lines",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("order_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("kind_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("product_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("description", sa.String(length=255), nullable=True),
+        sa.Column("price", sa.Float(), nullable=True),
+        sa.Column("quantity", sa.Integer(), nullable=True),
+        sa.Column("grams", sa.Float(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("rolled_up_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["order_id"], ["orders.id"], ondelete="SET NULL"),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_order_lines_id"), "order_lines", ["id"], unique=False)
+    op.create_index(op.f("ix_order_lines_order_id"), "order_lines", ["order_id"], unique=False)
+    op.create_index(
+        "ix_order_lines_not_rolled_up",
+        "order_lines",
+        ["created_at"],
+        unique=False,
+        postgresql_where=sa.text("rolled_up_at IS NULL OR order_id IS NULL"),
+    )
+    op.create_index("ix_order_lines_shop_id_created_at", "order_lines", ["shop_id", "created_at"], unique=False)
+    op.create_table(
+        "shop_sales_daily",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("item_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("kind_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("product_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+        sa.Column("grams", sa.Float(), nullable=False),
+        sa.Column("revenue", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_shop_sales_daily_id"), "shop_sales_daily", ["id"], unique=False)
+    op.create_index(
+        "ix_shop_sales_daily_shop_id_day_item_id", "shop_sales_daily", ["shop_id", "day", "item_id"], unique=True
+    )
+
+    # Split the `order_info` of existing orders into order lines. Some older orders hold their items as a JSON
+    # encoded string. The grams of joints and pieces aren't known anymore: joints count as 0.4 gram. The next run of
+    # `flask roll-up-sales` adds these lines to the rollups.
+    op.execute(
+        sa.text(
+            """
+            INSERT INTO order_lines
+                (id, order_id, shop_id, kind_id, product_id, description, price, quantity, grams, created_at)
+            SELECT
+                md5(orders.id::text || item.position::text)::uuid,
+                orders.id,
+                orders.shop_id,
+                CASE WHEN item.value->>'kind_id' ~ :uuid_pattern THEN (item.value->>'kind_id')::uuid END,
+                CASE WHEN item.value->>'product_id' ~ :uuid_pattern THEN (item.value->>'product_id')::uuid END,
+                item.value->>'description',
+                (item.value->>'price')::float,
+                (item.value->>'quantity')::integer,
+                (item.value->>'quantity')::integer * CASE item.value->>'description'
+                    WHEN '0,5 gram' THEN 0.5
+                    WHEN '1 gram' THEN 1
+                    WHEN '2,5 gram' THEN 2.5
+                    WHEN '5 gram' THEN 5
+                    WHEN '1 joint' THEN 0.4
+                    ELSE 0
+                END,
+                orders.created_at
+            FROM (
+                SELECT
+                    id,
+                    shop_id,
+                    created_at,
+                    CASE json_typeof(order_info)
+                        WHEN 'string' THEN (order_info #>> '{}')::json
+                        ELSE order_info
+                    END AS items
+                FROM orders
+            ) AS orders
+            CROSS JOIN LATERAL json_array_elements(
+                CASE WHEN json_typeof(orders.items) = 'array' THEN orders.items ELSE '[]'::json END
+            ) WITH ORDINALITY AS item(value, position)
+            """
+        ).bindparams(uuid_pattern=UUID_PATTERN)
+    )
+
+
+def downgrade():
+    op.drop_index("ix_shop_sales_daily_shop_id_day_item_id", table_name="shop_sales_daily")
+    op.drop_index(op.f("ix_shop_sales_daily_id"), table_name="shop_sales_daily")
+    op.drop_table("shop_sales_daily")
+    op.drop_index("ix_order_lines_shop_id_created_at", table_name="order_lines")
+    op.drop_index("ix_order_lines_not_rolled_up", table_name="order_lines")
+    op.drop_index(op.f("ix_order_lines_order_id"), table_name="order_lines")
+    op.drop_index(op.f("ix_order_lines_id"), table_name="order_lines")
+    op.drop_table("order_lines")
@@ -0,0 +1,38 @@
+"""add shop menu snapshots
+
+Revision ID: 977a93975f12
+Revises: 3cb638cdf175
+Create Date: 2026-10-17 19:40:12.220531
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "977a93975f12"
+down_revision = "3cb638cdf175"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "shop_menus",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("shop_modified_at", sa.DateTime(), nullable=True),
+        sa.Column("payload", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_shop_menus_id"), "shop_menus", ["id"], unique=False)
+    op.create_index(op.f("ix_shop_menus_shop_id"), "shop_menus", ["shop_id"], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_shop_menus_shop_id"), table_name="shop_menus")
+    op.drop_index(op.f("ix_shop_menus_id"), table_name="shop_menus")
+    op.drop_table("shop_menus")
@@ -0,0 +1,43 @@
+"""add order idempotency keys
+
+Revision ID: c4e81b2d7f65
+Revises: 5b1e0c7f3a92
+Create Date: 2026-10-17 22:41:07.532918
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "c4e81b2d7f65"
+down_revision = "5b1e0c7f3a92"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "order_idempotency_keys",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("shop_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("key", sa.String(length=255), nullable=False),
+        sa.Column("order_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("response", sa.JSON(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["order_id"], ["orders.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["shop_id"], ["shops.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_order_idempotency_keys_id"), "order_idempotency_keys", ["id"], unique=False)
+    op.create_index(
+        op.f("ix_order_idempotency_keys_created_at"), "order_idempotency_keys", ["created_at"], unique=False
+    )
+    op.create_index("ix_order_idempotency_keys_shop_id_key", "order_idempotency_keys", ["shop_id", "key"], unique=True)
+
+
+def downgrade():
+    op.drop_index("ix_order_idempotency_keys_shop_id_key", table_name="order_idempotency_keys")
+    op.drop_index(op.f("ix_order_idempotency_keys_created_at"), table_name="order_idempotency_keys")
+    op.drop_index(op.f("ix_order_idempotency_keys_id"), table_name="order_idempotency_keys")
+    op.drop_table("order_idempotency_keys")
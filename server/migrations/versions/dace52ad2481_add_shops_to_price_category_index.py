@@ -0,0 +1,27 @@
+"""add shops to price category order index
+
+Revision ID: dace52ad2481
+Revises: 09f0d2ed9f37
+Create Date: 2026-10-17 21:24:19.530274
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "dace52ad2481"
+down_revision = "09f0d2ed9f37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_shops_to_price_shop_id_category_id_order_number",
+        "shops_to_price",
+        ["shop_id", "category_id", "order_number"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_shops_to_price_shop_id_category_id_order_number", table_name="shops_to_price")
@@ -0,0 +1,22 @@
+"""add orders shop status created at index
+
+Revision ID: e2a9c3f18b47
+Revises: c4e81b2d7f65
+Create Date: 2026-10-17 23:05:52.804417
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e2a9c3f18b47"
+down_revision = "c4e81b2d7f65"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_orders_shop_id_status_created_at", "orders", ["shop_id", "status", "created_at"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_orders_shop_id_status_created_at", table_name="orders")
@@ -2,10 +2,10 @@ import datetime
 import json
 import os
 import uuid
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine.url import make_url
 
 from server.database import (
@@ -15,6 +15,7 @@ from server.database import (
     KindToFlavor,
     KindToStrain,
     KindToTag,
+    MainCategory,
     Order,
     Price,
     Product,
@@ -355,6 +356,48 @@ def shop_with_products(shop_1, kind_1, kind_2, price_1, price_2, price_3, produc
     return shop_1
 
 
+@pytest.fixture
+def shop_with_large_menu(shop_1, strain_1, strain_2):
+    """A shop with 300 price relations spread over 3 categories: half of them cannabis, half horeca."""
+    main_category = MainCategory(
+        id=str(uuid.uuid4()), name="Main", name_en="Main", description="Main description", shop_id=shop_1.id
+    )
+    db.session.add(main_category)
+    categories = [
+        Category(
+            id=str(uuid.uuid4()),
+            name=f"Large category {i}",
+            description=f"Large category description {i}",
+            shop_id=shop_1.id,
+            main_category_id=main_category.id,
+        )
+        for i in range(3)
+    ]
+    db.session.add_all(categories)
+    for i in range(150):
+        kind = Kind(id=str(uuid.uuid4()), name=f"Kind {i}", short_description_nl="NL", short_description_en="EN")
+        product = Product(id=str(uuid.uuid4()), name=f"Product {i}", short_description_nl="NL")
+        kind_price = Price(id=str(uuid.uuid4()), internal_product_id=f"k{i}", one=10.0, five=45.0, joint=4.5)
+        product_price = Price(id=str(uuid.uuid4()), internal_product_id=f"p{i}", piece=2.5)
+        db.session.add_all([kind, product, kind_price, product_price])
+        db.session.add(KindToStrain(id=str(uuid.uuid4()), kind_id=kind.id, strain_id=strain_1.id))
+        db.session.add(KindToStrain(id=str(uuid.uuid4()), kind_id=kind.id, strain_id=strain_2.id))
+        db.session.add(
+            ShopToPrice(price_id=kind_price.id, shop_id=shop_1.id, kind_id=kind.id, category_id=categories[i % 3].id)
+        )
+        db.session.add(
+            ShopToPrice(
+                price_id=product_price.id,
+                shop_id=shop_1.id,
+                product_id=product.id,
+                category_id=categories[i % 3].id,
+                order_number=i,
+            )
+        )
+    db.session.commit()
+    return shop_1
+
+
 @pytest.fixture
 def shop_with_orders(shop_with_products, kind_1, kind_2, price_1, price_2, table_1):
     items = [
@@ -448,3 +491,37 @@ def shop_with_mixed_orders(shop_with_products, kind_1, kind_2, price_1, price_2,
     db.session.add(order)
     db.session.commit()
     return shop_1
+
+
+@pytest.fixture
+def menu_cache():
+    """The menu cache of this process, enabled as if it's listening for invalidations."""
+    from apis.menu_cache import menu_cache
+
+    menu_cache.max_bytes = 10 * 1024 * 1024
+    menu_cache.listening = True
+    yield menu_cache
+    menu_cache.max_bytes = 0
+    menu_cache.listening = False
+    menu_cache.clear()
+
+
+@pytest.fixture
+def record_statements():
+    """Record the SQL statements that are executed in a `with record_statements() as statements:` block."""
+    from database import db
+
+    @contextmanager
+    def record():
+        statements = []
+
+        def listener(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+
+    return record
@@ -1,5 +1,33 @@
+import json
+from unittest import mock
+
+
 def test_kinds_list_endpoint(client, kind_1):
     response = client.get(f"/v1/kinds", follow_redirects=True)
     assert response.status_code == 200
     json = response.json
     assert len(json) == 1
+
+
+def test_kinds_detail_endpoint_language(client, kind_1):
+    response = client.get(f"/v1/kinds/{kind_1.id}?lang=en")
+    assert response.status_code == 200
+    assert response.json["short_description"] == kind_1.short_description_en
+    assert response.json["description"] == kind_1.description_en
+    assert "short_description_nl" not in response.json
+
+
+def test_kinds_list_quick_search(client, kind_1, kind_2):
+    def search(q):
+        response = client.get("/v1/kinds", query_string={"filter": json.dumps({"q": q})}, follow_redirects=True)
+        assert response.status_code == 200
+        return [kind["name"] for kind in response.json]
+
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            # Matches in the name rank above matches in the descriptions
+            assert search("sativa") == [kind_2.name, kind_1.name]
+            assert search("indica") == [kind_1.name, kind_2.name]
+            # Substrings and words in any order
+            assert search("amnes") == [kind_1.name]
+            assert search("indica good") == [kind_2.name]
@@ -1,7 +1,14 @@
+import base64
+import datetime
+import json
+import threading
+import uuid
 from unittest import mock
 
-from apis.v1.orders import get_price_rules_total
-from database import Order
+from apis.order_events import order_event_broker
+from apis.sales import roll_up_sales
+from apis.v1.orders import next_customer_order_id, price_order, purge_idempotency_keys
+from database import Order, OrderLine, Shop, ShopToPrice, Table, User, db
 
 
 def test_order_list(client, shop_with_orders):
@@ -128,6 +135,64 @@ def test_create_mixed_order(client, price_1, price_2, price_3, product_1, kind_1
     assert order.customer_order_id == 2
 
 
+def test_customer_order_ids_are_unique(app, shop_1):
+    shop_id = shop_1.id
+    customer_order_ids = []
+
+    def allocate():
+        with app.app_context():
+            customer_order_ids.append(next_customer_order_id(shop_id))
+            db.session.commit()
+
+    threads = [threading.Thread(target=allocate) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(customer_order_ids) == list(range(1, 11))
+
+    # Ids of rolled back orders are handed out again
+    next_customer_order_id(shop_id)
+    db.session.rollback()
+    assert next_customer_order_id(shop_id) == 11
+
+
+def test_create_order_idempotency_key(app, client, price_1, kind_1, shop_with_products, table_1, record_statements):
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 1}
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 10.0, "order_info": items}
+    headers = {"Idempotency-Key": "7b0f5d2c-order-1"}
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer") as send_message:
+        response = client.post("/v1/orders", json=data, headers=headers, follow_redirects=True)
+        assert response.status_code == 201
+        retry = client.post("/v1/orders", json=data, headers=headers, follow_redirects=True)
+        assert retry.status_code == 201
+        assert retry.json == response.json
+        send_message.assert_called_once()
+    assert Order.query.count() == 1
+
+    # Another key is another order
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        response = client.post("/v1/orders", json=data, headers={"Idempotency-Key": "7b0f5d2c-order-2"})
+        assert response.json["customer_order_id"] == 2
+
+        # Expired keys aren't replayed, they're purged periodically instead of by submissions
+        with mock.patch.dict(app.config, {"ORDER_IDEMPOTENCY_TTL": 0}):
+            with record_statements() as statements:
+                response = client.post("/v1/orders", json=data, headers=headers)
+            assert response.json["customer_order_id"] == 3
+            assert not [statement for statement in statements if statement.startswith("DELETE")]
+            assert purge_idempotency_keys() == 2
+
+    # Only clients that are allowed to order get the response of a submission
+    Shop.query.filter_by(id=shop_with_products.id).update({"allowed_ips": ["10.0.0.1"]})
+    db.session.commit()
+    response = client.post("/v1/orders", json=data, headers=headers)
+    assert response.status_code == 400
+    assert response.json["message"] == "NOT_ON_SHOP_WIFI"
+
+
 def test_create_order_validation(client, price_1, price_2, kind_1, kind_2, shop_with_products, table_1):
     items = [
         {
@@ -165,6 +230,122 @@ def test_create_order_validation(client, price_1, price_2, kind_1, kind_2, shop_
     # Todo: test checksum functionality (totals should match with quantity in items)
 
 
+def test_create_order_out_of_stock(client, price_3, product_1, kind_1, kind_2, shop_with_products, table_1):
+    ShopToPrice.query.filter_by(kind_id=kind_1.id).first().active = False
+    db.session.commit()
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 1},
+        {"description": "0,5 gram", "price": 5.0, "kind_id": str(kind_2.id), "kind_name": kind_2.name, "quantity": 1},
+        {
+            "description": "1",
+            "price": price_3.piece,
+            "product_id": str(product_1.id),
+            "product_name": product_1.name,
+            "quantity": 1,
+        },
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 17.5, "order_info": items}
+    response = client.post("/v1/orders", json=data, follow_redirects=True)
+    assert response.status_code == 400
+    # All unavailable lines are reported at once
+    assert response.json["message"] == "Indica, Sativa, OUT_OF_STOCK"
+    assert response.json["unavailable_product_names"] == ["Indica", "Sativa"]
+    assert Order.query.count() == 0
+
+
+def test_create_order_availability_from_memory(client, price_1, kind_1, shop_with_products, table_1, record_statements):
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 1}
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 10.0, "order_info": items}
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 201
+
+        with record_statements() as statements:
+            response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 201
+        assert not [statement for statement in statements if "shops_to_price" in statement]
+
+        # Toggling the stock rebuilds the availability once
+        shop_to_price = ShopToPrice.query.filter_by(kind_id=kind_1.id).first()
+        with mock.patch("flask_security.decorators._check_token", return_value=True):
+            with mock.patch("flask_principal.Permission.can", return_value=True):
+                response = client.put(f"/v1/shops-to-prices/availability/{shop_to_price.id}", json={"active": False})
+                assert response.status_code == 200
+        with record_statements() as statements:
+            response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 400
+        assert response.json["unavailable_product_names"] == [kind_1.name]
+        assert [statement for statement in statements if "shops_to_price" in statement]
+        with record_statements() as statements:
+            response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 400
+        assert not [statement for statement in statements if "shops_to_price" in statement]
+
+
+def test_create_order_availability_after_move(client, price_1, kind_1, shop_with_products, shop_2, table_1):
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 1}
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 10.0, "order_info": items}
+    shop_to_price = ShopToPrice.query.filter_by(kind_id=kind_1.id).first()
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        with mock.patch("flask_security.decorators._check_token", return_value=True):
+            with mock.patch("flask_principal.Permission.can", return_value=True):
+                assert client.post("/v1/orders", json=data).status_code == 201
+
+                # Moving the price relation to another shop takes it out of the availability of the previous one
+                payload = {
+                    "price_id": str(price_1.id),
+                    "shop_id": str(shop_2.id),
+                    "kind_id": str(kind_1.id),
+                    "product_id": None,
+                }
+                response = client.put(f"/v1/shops-to-prices/{shop_to_price.id}", json=payload)
+                assert response.status_code == 201
+                response = client.post("/v1/orders", json=data)
+                assert response.json["unavailable_product_names"] == [kind_1.name]
+                data["shop_id"] = str(shop_2.id)
+                assert client.post("/v1/orders", json=data).status_code == 201
+
+
+def test_pending_orders_cursor_pagination(client, shop_1):
+    now = datetime.datetime.utcnow()
+    for i in range(5):
+        db.session.add(
+            Order(id=str(uuid.uuid4()), shop_id=shop_1.id, status="pending", customer_order_id=i, created_at=now)
+        )
+    db.session.add(Order(id=str(uuid.uuid4()), shop_id=shop_1.id, status="complete", created_at=now))
+    db.session.commit()
+    expected = [
+        str(order.id)
+        for order in Order.query.filter_by(status="pending").order_by(Order.created_at.desc(), Order.id.desc())
+    ]
+
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            response = client.get(f"/v1/orders/shop/{shop_1.id}/pending?limit=2&count=true")
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == "5"
+            ids = [order["id"] for order in response.json]
+            while "X-Next-Cursor" in response.headers:
+                response = client.get(
+                    f"/v1/orders/shop/{shop_1.id}/pending?limit=2&cursor={response.headers['X-Next-Cursor']}"
+                )
+                assert "X-Total-Count" not in response.headers
+                ids += [order["id"] for order in response.json]
+            # Orders created at the same moment are neither skipped nor repeated
+            assert ids == expected
+
+            for cursor in ("nonsense", base64.urlsafe_b64encode(b'["2021-01-01T00:00:00", 5]').decode()):
+                response = client.get(f"/v1/orders/shop/{shop_1.id}/pending?cursor={cursor}")
+                assert response.status_code == 400
+            for limit in (0, -5):
+                response = client.get(f"/v1/orders/shop/{shop_1.id}/pending?limit={limit}")
+                assert response.status_code == 400
+
+
 def test_patch_order_to_complete(client, shop_with_orders, admin):
     # Get the uncompleted order_id from the fixture:
     order = Order.query.filter_by(status="pending").first()
@@ -182,142 +363,298 @@ def test_patch_order_to_complete(client, shop_with_orders, admin):
                 assert updated_order.completed_at is not None
 
 
-def test_price_rules():
-    order_info = [
-        {
-            "description": "1 gram",
-            "price": 8,
-            "kind_id": "fd2f4ee4-a58e-425d-998b-003757b790eb",
-            "kind_name": "Soort 1",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 1,
-            "quantity": 1,
-        },
+def test_order_lists_query_count(client, shop_1, record_statements):
+    # Every order has its own table and user, so lazy loading them would cost queries per order
+    for index in range(100):
+        user = User(id=uuid.uuid4(), email=f"employee{index}@example.com", first_name=f"Employee {index}")
+        table = Table(id=uuid.uuid4(), shop_id=shop_1.id, name=f"table {index}")
+        db.session.add_all([user, table])
+        order = Order(
+            id=uuid.uuid4(),
+            shop_id=shop_1.id,
+            table_id=table.id,
+            total=10.0,
+            customer_order_id=index + 1,
+            status="complete",
+            completed_by=user.id,
+            completed_at=datetime.datetime.utcnow(),
+        )
+        db.session.add(order)
+    db.session.commit()
+
+    def count_statements(url):
+        db.session.expunge_all()
+        with record_statements() as statements:
+            response = client.get(url, follow_redirects=True)
+        assert response.status_code == 200
+        return len(statements), response.json
+
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            for url in ["/v1/orders", f"/v1/orders/shop/{shop_1.id}/complete"]:
+                few, _ = count_statements(f"{url}?range=[0,9]")
+                many, orders = count_statements(f"{url}?range=[0,99]")
+                assert len(orders) == 100
+                assert many == few
+                assert orders[0]["table_name"].startswith("table ")
+                assert orders[0]["completed_by_name"].startswith("Employee ")
+
+            statements, order = count_statements(f"/v1/orders/{orders[0]['id']}")
+            assert statements == 1
+            assert order["shop_name"] == shop_1.name
+
+
+def test_check_orders(client, shop_with_orders, shop_2, table_1, record_statements):
+    pending, complete = Order.query.order_by(Order.customer_order_id).all()
+    ids = f"{complete.id},{uuid.uuid4()},{pending.id}"
+
+    with record_statements() as statements:
+        response = client.get(f"/v1/orders/check/{ids}", follow_redirects=True)
+    assert response.status_code == 200
+    assert len(statements) == 1
+    # In the requested order, unknown ID's are left out
+    assert [order["id"] for order in response.json] == [str(complete.id), str(pending.id)]
+    assert response.json[0]["table_name"] == table_1.name
+    assert response.json[0]["status"] == "complete"
+    assert response.json[1]["table_name"] is None
+
+    other = Order(id=uuid.uuid4(), shop_id=shop_2.id, total=10.0, customer_order_id=1)
+    db.session.add(other)
+    db.session.commit()
+    response = client.get(f"/v1/orders/check/{pending.id},{other.id}", follow_redirects=True)
+    assert response.status_code == 400
+    assert response.json["message"] == "All ID's should belong to one shop"
+
+
+def test_order_lines_and_sales(app, client, price_1, price_2, kind_1, kind_2, shop_with_products, table_1):
+    items = [
         {
             "description": "1 gram",
-            "price": 25,
-            "kind_id": "593277e5-f301-4662-9cf5-488e2479bac0",
-            "kind_name": "Soort 2",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 47,
-            "quantity": 1,
+            "price": price_1.one,
+            "kind_id": str(kind_1.id),
+            "kind_name": kind_1.name,
+            "quantity": 2,
         },
         {
-            "description": "1 gram",
-            "price": 9,
-            "kind_id": "b13e26c3-834b-493f-a1d0-17859c41cea0",
-            "kind_name": "Soort 3",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 4,
+            "description": "1 joint",
+            "price": price_2.joint,
+            "kind_id": str(kind_2.id),
+            "kind_name": kind_2.name,
             "quantity": 1,
         },
     ]
-    assert get_price_rules_total(order_info) == 3
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 24.0, "order_info": items}
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 201
+        client.post("/v1/orders", json=data, follow_redirects=True)
 
-    # Check on quantity
-    order_info = [
-        {
-            "description": "1 gram",
-            "price": 8,
-            "kind_id": "fd2f4ee4-a58e-425d-998b-003757b790eb",
-            "kind_name": "Soort 1",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 1,
-            "quantity": 4,
-        },
-        {
-            "description": "1 gram",
-            "price": 25,
-            "kind_id": "593277e5-f301-4662-9cf5-488e2479bac0",
-            "kind_name": "Soort 2",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 47,
-            "quantity": 1,
-        },
-        {
-            "description": "1 gram",
-            "price": 9,
-            "kind_id": "b13e26c3-834b-493f-a1d0-17859c41cea0",
-            "kind_name": "Soort 3",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 4,
-            "quantity": 1,
-        },
+    lines = OrderLine.query.filter_by(order_id=response.json["id"]).order_by(OrderLine.quantity.desc()).all()
+    assert [(line.kind_id, line.quantity, line.price, line.grams) for line in lines] == [
+        (kind_1.id, 2, price_1.one, 2),
+        (kind_2.id, 1, price_2.joint, 0.4),
     ]
-    assert get_price_rules_total(order_info) == 6
 
-    # Check with 5g
-    order_info = [
-        {
-            "description": "5 gram",
-            "price": 8,
-            "kind_id": "fd2f4ee4-a58e-425d-998b-003757b790eb",
-            "kind_name": "Soort 1",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 1,
-            "quantity": 1,
-        },
-        {
-            "description": "1 gram",
-            "price": 25,
-            "kind_id": "593277e5-f301-4662-9cf5-488e2479bac0",
-            "kind_name": "Soort 2",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 47,
-            "quantity": 1,
-        },
-        {
-            "description": "1 gram",
-            "price": 9,
-            "kind_id": "b13e26c3-834b-493f-a1d0-17859c41cea0",
-            "kind_name": "Soort 3",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 4,
-            "quantity": 1,
-        },
+    def sales(query=""):
+        with mock.patch("flask_security.decorators._check_token", return_value=True):
+            with mock.patch("flask_principal.Permission.can", return_value=True):
+                response = client.get(f"/v1/shops/{shop_with_products.id}/sales{query}", follow_redirects=True)
+                assert response.status_code == 200
+                return {row["kind_name"]: row for row in response.json}
+
+    with mock.patch.dict(app.config, {"SALES_TIMEZONE": "UTC"}):
+        # Lines of pending orders are handled, but aren't sales yet
+        assert roll_up_sales() == 4
+        assert sales() == {}
+        orders = Order.query.all()
+        orders[0].status = "complete"
+        orders[1].status = "cancelled"
+        db.session.commit()
+        assert roll_up_sales() == 4
+        assert roll_up_sales() == 0
+
+        rows = sales()
+        assert rows[kind_1.name]["quantity"] == 2
+        assert rows[kind_1.name]["grams"] == 2
+        assert rows[kind_1.name]["revenue"] == price_1.one * 2
+        assert rows[kind_2.name]["quantity"] == 1
+        assert rows[kind_1.name]["day"] == datetime.datetime.utcnow().date().isoformat()
+        assert list(sales(f"?kind_id={kind_2.id}&start=2000-01-01")) == [kind_2.name]
+
+        # Later changes of orders correct the sales of their days
+        orders[1].status = "complete"
+        db.session.commit()
+        assert roll_up_sales() == 2
+        assert sales()[kind_1.name]["quantity"] == 4
+        orders[0].status = "pending"
+        db.session.commit()
+        roll_up_sales()
+        assert sales()[kind_1.name]["quantity"] == 2
+
+        orders[1].order_info = [dict(items[0], quantity=3)]
+        db.session.commit()
+        assert OrderLine.query.filter_by(order_id=orders[1].id).count() == 1
+        roll_up_sales()
+        rows = sales()
+        assert list(rows) == [kind_1.name]
+        assert rows[kind_1.name]["quantity"] == 3
+        assert rows[kind_1.name]["revenue"] == price_1.one * 3
+        # Replaced lines are deleted once their day is recomputed
+        assert OrderLine.query.filter_by(order_id=None).count() == 0
+
+    # Days are calendar days in the timezone of the sales
+    orders[1].created_at = datetime.datetime(2026, 10, 16, 23, 30)
+    db.session.commit()
+    roll_up_sales()
+    assert sales()[kind_1.name]["day"] == "2026-10-17"
+
+    db.session.delete(orders[1])
+    db.session.commit()
+    roll_up_sales()
+    assert sales() == {}
+    assert OrderLine.query.filter_by(order_id=None).count() == 0
+
+
+def test_order_list_typed_filters(client, shop_1, shop_with_orders, shop_2, record_statements):
+    def list_orders(filter):
+        response = client.get("/v1/orders", query_string={"filter": json.dumps(filter)}, follow_redirects=True)
+        if response.status_code != 200:
+            return response.status_code, response.json["message"]
+        return response.status_code, sorted(order["customer_order_id"] for order in response.json)
+
+    today = datetime.datetime.utcnow().date()
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            with record_statements() as statements:
+                assert list_orders({"shop_id": str(shop_1.id)}) == (200, [1, 2])
+            # Foreign keys are compared as UUIDs, so their index can be used
+            assert any("orders.shop_id = " in statement for statement in statements)
+            assert not any("CAST(orders.shop_id" in statement for statement in statements)
+
+            assert list_orders({"shop_id": str(shop_2.id)}) == (200, [])
+            assert list_orders({"shop_id": [str(shop_1.id), str(shop_2.id)]}) == (200, [1, 2])
+            assert list_orders({"customer_order_id": [2, 3]}) == (200, [2])
+            assert list_orders({"customer_order_id": 2}) == (200, [2])
+            assert list_orders({"total_gte": "24"}) == (200, [1, 2])
+            assert list_orders({"created_at": today.isoformat()}) == (200, [1, 2])
+            assert list_orders({"created_at": (today - datetime.timedelta(days=1)).isoformat()}) == (200, [])
+            assert list_orders({"created_at_lt": f"{today.isoformat()}T00:00:00Z"}) == (200, [])
+            assert list_orders({"status_prefix": "comp"}) == (200, [2])
+
+            assert list_orders({"shop_id": "Mississippi"})[0] == 400
+            assert list_orders({"total": "a lot"})[0] == 400
+            assert list_orders({"created_at": "today"})[0] == 400
+
+
+def test_price_order(app, price_1, price_2, price_3, kind_1, kind_2, product_1, shop_with_products):
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 4},
+        {"description": "1 joint", "price": 4.0, "kind_id": str(kind_2.id), "kind_name": kind_2.name, "quantity": 1},
+        {"description": "1", "price": 2.5, "product_id": str(product_1.id), "product_name": "Cola", "quantity": 2},
     ]
-    assert get_price_rules_total(order_info) == 7
+    # Joints without their own weight count as 0.4 gram
+    assert price_order(items, shop_with_products) == (49.0, 4.4, [])
 
-    # Check with joint
-    order_info = [
-        {
-            "description": "1 gram",
-            "price": 8,
-            "kind_id": "fd2f4ee4-a58e-425d-998b-003757b790eb",
-            "kind_name": "Soort 1",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 1,
-            "quantity": 4,
-        },
+    ShopToPrice.query.filter_by(kind_id=kind_2.id).first().joint_grams = 0.7
+    ShopToPrice.query.filter_by(product_id=product_1.id).first().piece_grams = 0.2
+    db.session.commit()
+    # Orders are priced for the shop as loaded by their request
+    shop = Shop.query.filter_by(id=shop_with_products.id).first()
+    assert price_order(items, shop) == (49.0, 5.1, [])
+
+    # Options without a price can't be ordered
+    items[0]["description"] = "2,5 gram"
+    assert price_order(items, shop) == (9.0, 1.1, [kind_1.name])
+
+
+def test_create_order_recomputes_total(client, kind_1, price_1, shop_with_products, table_1):
+    items = [
+        {"description": "5 gram", "price": 45.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 1}
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 40.0, "order_info": items}
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 400
+        assert response.json["message"] == "TOTAL_MISMATCH"
+        assert response.json["total"] == 45.0
+
+        items[0]["quantity"] = 2
+        data["total"] = 90.0
+        response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 400
+        assert response.json["message"] == "MAX_5_GRAMS_ALLOWED"
+    assert Order.query.count() == 0
+
+
+def test_create_order_after_price_change(client, kind_1, price_1, shop_with_products, table_1):
+    items = [
+        {"description": "1 gram", "price": 10.0, "kind_id": str(kind_1.id), "kind_name": kind_1.name, "quantity": 2}
+    ]
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 20.0, "order_info": items}
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        with mock.patch("flask_security.decorators._check_token", return_value=True):
+            with mock.patch("flask_principal.Permission.can", return_value=True):
+                assert client.post("/v1/orders", json=data).status_code == 201
+
+                response = client.put(f"/v1/prices/{price_1.id}", json={"internal_product_id": "01", "one": 11.0})
+                assert response.status_code == 201
+
+                # Orders are priced with the new price right away, by every worker
+                response = client.post("/v1/orders", json=data)
+                assert response.status_code == 400
+                assert response.json["message"] == "TOTAL_MISMATCH"
+                assert response.json["total"] == 22.0
+
+                items[0]["price"] = 11.0
+                data["total"] = 22.0
+                response = client.post("/v1/orders", json=data)
+                assert response.status_code == 201
+                assert response.json["total"] == 22.0
+
+
+def test_order_events(client, price_1, kind_1, shop_with_products, table_1):
+    events = order_event_broker.subscribe(shop_with_products.id)
+    items = [
         {
             "description": "1 gram",
-            "price": 25,
-            "kind_id": "593277e5-f301-4662-9cf5-488e2479bac0",
-            "kind_name": "Soort 2",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 47,
-            "quantity": 1,
-        },
-        {
-            "description": "joint",
-            "price": 6,
-            "kind_id": "a99f677f-14dc-4d67-9d41-ff3e85dd09fc",
-            "kind_name": "Mega Joint",
-            "product_id": None,
-            "product_name": None,
-            "internal_product_id": 26,
+            "price": price_1.one,
+            "kind_id": str(kind_1.id),
+            "kind_name": kind_1.name,
             "quantity": 1,
-        },
+        }
     ]
-    assert get_price_rules_total(order_info) == 5.4
+    data = {"shop_id": str(shop_with_products.id), "table_id": str(table_1.id), "total": 10.0, "order_info": items}
+    try:
+        with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+            response = client.post("/v1/orders", json=data, follow_redirects=True)
+        assert response.status_code == 201
+
+        event = events.get_nowait()
+        assert event["type"] == "pending_orders"
+        assert event["order"]["id"] == response.json["id"]
+        assert event["order"]["status"] == "pending"
+        assert event["order"]["order_info"][0]["kind_name"] == kind_1.name
+    finally:
+        order_event_broker.unsubscribe(shop_with_products.id, events)
+
+
+def test_order_events_stream(client, shop_1):
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            url = f"/v1/orders/shop/{shop_1.id}/events"
+            checked_out = db.engine.pool.checkedout()
+            response = client.get(url, buffered=False)
+            assert response.status_code == 200
+            assert response.mimetype == "text/event-stream"
+            assert response.headers["Cache-Control"] == "no-cache"
+
+            stream = iter(response.response)
+            assert next(stream) == b"retry: 3000\n: connected\n\n"
+            # Open streams don't keep a database connection
+            assert db.engine.pool.checkedout() == checked_out
+            order_event_broker.deliver(
+                shop_1.id, {"type": "completed_orders", "order": {"id": "1", "status": "complete"}}
+            )
+            assert next(stream) == b'id: 1\nevent: completed_orders\ndata: {"id": "1", "status": "complete"}\n\n'
+            response.close()
+            assert str(shop_1.id) not in order_event_broker._subscribers
@@ -1,3 +1,10 @@
+import json
+from unittest import mock
+
+from apis.filters import compile_filter
+from apis.totals import list_totals
+
+
 def test_prices_list_endpoint(client, price_1):
     response = client.get(f"/v1/prices", follow_redirects=True)
     assert response.status_code == 403
@@ -7,3 +14,83 @@ def test_prices_create_endpoint(client):
     data = {"internal_product_id": 5, "one": 10.1, "five": 0.43}
     response = client.post(f"/v1/prices", json=data, follow_redirects=True)
     assert response.status_code == 403
+
+
+def test_prices_list_filters(client, price_1, price_2, price_3):
+    def list_prices(filter):
+        response = client.get("/v1/prices", query_string={"filter": json.dumps(filter)}, follow_redirects=True)
+        return response.status_code, sorted(price["internal_product_id"] for price in response.json or [])
+
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            assert list_prices({"q": "0"}) == (200, ["01", "02", "03"])
+            assert list_prices({"q": "2", "one": None}) == (200, ["02"])
+            assert list_prices({"q": 2}) == (200, ["02"])
+            assert list_prices({"one_gte": 7.5}) == (200, ["01", "02"])
+            assert list_prices({"one_gt": 7.5, "internal_product_id": "1"}) == (200, ["01"])
+            assert list_prices({"id": [str(price_1.id), str(price_3.id)]}) == (200, ["01", "03"])
+            assert list_prices({"internal_product_id_prefix": "0"}) == (200, ["01", "02", "03"])
+            # Other columns than text are matched on their text
+            assert list_prices({"one_prefix": "7"}) == (200, ["02"])
+
+            # The compiled filter is reused for other values
+            compiled = compile_filter.cache_info().hits
+            assert list_prices({"one_gte": 10}) == (200, ["01"])
+            assert compile_filter.cache_info().hits == compiled + 1
+
+            response = client.get("/v1/prices", query_string={"filter": '{"price_id": "1"}'}, follow_redirects=True)
+            assert response.status_code == 400
+            assert response.json["message"] == "Unknown column: price_id"
+            response = client.get("/v1/prices", query_string={"filter": "{'one': 1}"}, follow_redirects=True)
+            assert response.status_code == 400
+            response = client.get("/v1/prices", query_string={"filter": '{"one": true}'}, follow_redirects=True)
+            assert response.status_code == 400
+            assert response.json["message"] == "Invalid value for one: True"
+
+
+def test_prices_list_count_modes(app, client, price_1, price_2, price_3, record_statements):
+    def list_prices(**query_string):
+        with record_statements() as statements:
+            response = client.get("/v1/prices", query_string=query_string, follow_redirects=True)
+        count = len([statement for statement in statements if "prices" in statement])
+        return response.status_code, response.headers.get("Content-Range"), count
+
+    try:
+        with mock.patch("flask_security.decorators._check_token", return_value=True):
+            with mock.patch("flask_principal.Permission.can", return_value=True):
+                assert list_prices(range="[0,0]") == (200, "items 0-0/3", 2)
+                assert list_prices(range="[0,0]", count_mode="windowed") == (200, "items 0-0/3", 1)
+                assert list_prices(range="[5,9]", count_mode="windowed") == (200, "items 5-9/3", 2)
+                assert list_prices(range="[0,0]", count_mode="none") == (200, "items 0-0/*", 1)
+                # Too few rows to trust the estimate of the planner
+                assert list_prices(range="[0,0]", count_mode="estimated")[1] == "items 0-0/3"
+                assert list_prices(count_mode="all")[0] == 400
+
+                app.config["LIST_TOTALS_TTL"] = 60
+                list_totals.clear()
+                assert list_prices(range="[0,0]") == (200, "items 0-0/3", 2)
+                assert list_prices(range="[1,1]") == (200, "items 1-1/3", 1)
+                assert list_prices(range="[0,0]", filter='{"q": "1"}') == (200, "items 0-0/1", 2)
+    finally:
+        app.config["LIST_TOTALS_TTL"] = 0
+        list_totals.clear()
+
+
+def test_prices_get_many(client, price_1, price_2, price_3, record_statements):
+    def get_many(ids):
+        filter = json.dumps({"id": ids})
+        response = client.get("/v1/prices", query_string={"filter": filter, "sort": '["internal_product_id","ASC"]'})
+        if response.status_code != 200:
+            return response.status_code, response.json["message"]
+        return response.status_code, [price["internal_product_id"] for price in response.json]
+
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            with record_statements() as statements:
+                # In the requested order
+                assert get_many([str(price_3.id), str(price_1.id), str(price_2.id)]) == (200, ["03", "01", "02"])
+            assert any("prices.id = ANY (CAST(" in statement for statement in statements)
+
+            assert get_many([str(price_2.id).upper()]) == (200, ["02"])
+            assert get_many([]) == (200, [])
+            assert get_many([str(price_1.id), "01"])[0] == 400
@@ -1,3 +1,17 @@
+import gzip
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import brotli
+from apis.helpers import invalidateShopCache
+from apis.menu import build_shop_menu, build_shop_menu_variant, get_or_rebuild_shop_menu, purge_menu_tombstones
+from apis.menu_cache import MENU_CACHE_CHANNEL, CachedMenu, MenuCache, handle_notification
+from database import Category, Kind, Price, Shop, ShopMenu, ShopToPrice, ShopToPriceTombstone, db
+
+
 def test_shops_list_endpoint(client, shop_1):
     response = client.get(f"/v1/shops", follow_redirects=True)
     assert response.status_code == 403
@@ -8,6 +22,363 @@ def test_shops_detail_endpoint(client, shop_with_products):
     assert response.status_code == 200
 
 
+def test_shops_detail_endpoint_serves_menu_snapshot(client, shop_with_products):
+    response = client.get(f"/v1/shops/{shop_with_products.id}", follow_redirects=True)
+    assert response.status_code == 200
+    assert response.json["name"] == "Mississippi"
+    menu = ShopMenu.query.filter_by(shop_id=shop_with_products.id).first()
+    assert menu.version == 1
+
+    # A second request is served from the same snapshot
+    response = client.get(f"/v1/shops/{shop_with_products.id}", follow_redirects=True)
+    assert response.status_code == 200
+    assert ShopMenu.query.filter_by(shop_id=shop_with_products.id).first().version == 1
+
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer") as send_message:
+        invalidateShopCache(shop_with_products.id)
+        send_message.assert_called_once()
+    assert ShopMenu.query.filter_by(shop_id=shop_with_products.id).first().version == 2
+
+
+def test_shops_detail_endpoint_menu_cache(client, shop_with_products, menu_cache, record_statements):
+    response = client.get(f"/v1/shops/{shop_with_products.id}")
+    assert response.status_code == 200
+    assert menu_cache.stats()["misses"] == 1
+    with record_statements() as statements:
+        cached = client.get(f"/v1/shops/{shop_with_products.id}")
+    assert cached.data == response.data
+    assert cached.headers["ETag"] == response.headers["ETag"]
+    assert menu_cache.stats()["hits"] == 1
+    # Served without touching the database
+    assert statements == []
+
+    # Other workers are notified when the transaction commits
+    connection = db.engine.raw_connection()
+    connection.connection.autocommit = True
+    connection.cursor().execute(f"LISTEN {MENU_CACHE_CHANNEL}")
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        invalidateShopCache(shop_with_products.id)
+    connection.connection.poll()
+    notifications = [notify.payload for notify in connection.connection.notifies]
+    connection.close()
+    assert len(notifications) == 1
+    assert menu_cache.stats()["menus"] == 0
+
+    response = client.get(f"/v1/shops/{shop_with_products.id}")
+    assert response.headers["ETag"] != cached.headers["ETag"]
+    assert menu_cache.stats()["menus"] == 1
+    # As they are received by the listener of a worker
+    handle_notification(notifications[0])
+    assert menu_cache.stats()["menus"] == 0
+
+
+def test_shops_detail_endpoint_after_menu_changes(client, shop_with_large_menu, menu_cache):
+    def menu_row(internal_product_id):
+        response = client.get(f"/v1/shops/{shop_with_large_menu.id}")
+        assert response.status_code == 200
+        return next(row for row in response.json["prices"] if row["internal_product_id"] == internal_product_id)
+
+    row = menu_row("k0")
+    assert row["one"] == 10.0
+    price = Price.query.filter_by(internal_product_id="k0").first()
+    category = Category.query.filter_by(id=row["category_id"]).first()
+
+    # Prices and categories are edited without invalidating the shop cache, the menu follows them anyway
+    with mock.patch("flask_security.decorators._check_token", return_value=True):
+        with mock.patch("flask_principal.Permission.can", return_value=True):
+            response = client.put(f"/v1/prices/{price.id}", json={"internal_product_id": "k0", "one": 99.0})
+            assert response.status_code == 201
+            assert menu_row("k0")["one"] == 99.0
+
+            data = {"name": "Renamed category", "icon": category.icon, "shop_id": str(shop_with_large_menu.id)}
+            response = client.put(f"/v1/categories/{category.id}", json=data)
+            assert response.status_code == 201
+            assert menu_row("k0")["category_name"] == "Renamed category"
+
+    # Like changes made outside of the API, e.g. in the admin views
+    Kind.query.filter_by(name="Kind 0").first().name = "Kind zero"
+    db.session.commit()
+    assert menu_row("k0")["kind_name"] == "Kind zero"
+
+
+def test_shop_menu_single_flight_rebuild(app, shop_with_products):
+    shop_id = shop_with_products.id
+    builds = []
+
+    def slow_build(shop, variant):
+        builds.append(variant)
+        time.sleep(0.2)
+        return build_shop_menu_variant(shop, variant)
+
+    def get_menu(results, stale_while_revalidate=False):
+        with app.app_context():
+            menu, stale = get_or_rebuild_shop_menu(shop_id, "compact", stale_while_revalidate)
+            results.append((menu.version, stale))
+
+    def get_menus_concurrently(stale_while_revalidate=False):
+        results = []
+        threads = [threading.Thread(target=get_menu, args=(results, stale_while_revalidate)) for _ in range(5)]
+        with mock.patch("apis.menu.build_shop_menu_variant", side_effect=slow_build):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    # Concurrent requests wait for the one rebuild
+    assert sorted(get_menus_concurrently()) == [(1, False)] * 5
+    assert builds == ["compact"]
+
+    shop = Shop.query.filter_by(id=shop_id).first()
+    shop.modified_at = datetime.utcnow()
+    db.session.commit()
+
+    # Or get the previous snapshot during the rebuild
+    results = get_menus_concurrently(stale_while_revalidate=True)
+    assert builds == ["compact", "compact"]
+    assert sorted(results) == [(1, True)] * 4 + [(2, False)]
+
+
+def test_menu_cache_bounded():
+    cache = MenuCache(max_bytes=100)
+    cache.listening = True
+    now = datetime.utcnow()
+    for shop_id in ("a", "b", "c"):
+        cache.put(CachedMenu(shop_id, "full", 1, now, "x" * 40, None, None, now))
+    assert cache.get("a", "full") is None
+    assert cache.get("b", "full") and cache.get("c", "full")
+    assert cache.stats()["size"] == 80
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+    # Menus older than an invalidation are never cached again
+    cache.invalidate("b", datetime.utcnow())
+    cache.put(CachedMenu("b", "full", 1, now, "x" * 40, None, None, now))
+    assert cache.get("b", "full") is None
+
+    # Without a listener the cache can't be trusted
+    cache.listening = False
+    assert cache.get("c", "full") is None
+
+
+def test_shops_detail_endpoint_conditional_get(client, shop_with_products):
+    response = client.get(f"/v1/shops/{shop_with_products.id}", follow_redirects=True)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert not etag.startswith("W/")
+
+    response = client.get(f"/v1/shops/{shop_with_products.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+    response = client.get(f"/v1/shops/{shop_with_products.id}", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    with mock.patch("apis.helpers.sendMessageToWebSocketServer"):
+        invalidateShopCache(shop_with_products.id)
+    response = client.get(f"/v1/shops/{shop_with_products.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["name"] == "Mississippi"
+
+
+def test_shops_detail_endpoint_precompressed(client, shop_with_products):
+    response = client.get(f"/v1/shops/{shop_with_products.id}")
+    plain = response.json
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = client.get(f"/v1/shops/{shop_with_products.id}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.data)) == plain
+    gzip_etag = response.headers["ETag"]
+
+    response = client.get(f"/v1/shops/{shop_with_products.id}", headers={"Accept-Encoding": "gzip, deflate, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(response.data)) == plain
+    assert response.headers["ETag"] != gzip_etag
+
+    response = client.get(
+        f"/v1/shops/{shop_with_products.id}", headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}
+    )
+    assert response.status_code == 304
+
+
+def test_shops_detail_endpoint_compact_format(client, shop_with_large_menu):
+    full = client.get(f"/v1/shops/{shop_with_large_menu.id}")
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?format=compact")
+    assert response.status_code == 200
+    compact = response.json
+    assert len(response.data) * 3 < len(full.data)
+    assert response.headers["ETag"] != full.headers["ETag"]
+
+    assert len(compact["main_categories"]) == 1
+    assert len(compact["categories"]) == 3
+    assert len(compact["kinds"]) == 150
+    assert len(compact["products"]) == 150
+    assert len(compact["prices"]["rows"]) == 300
+
+    # Every compact row resolves to the same data as the full row
+    columns = compact["prices"]["columns"]
+    for full_row, compact_row in zip(full.json["prices"], compact["prices"]["rows"]):
+        row = dict(zip(columns, compact_row))
+        category = compact["categories"][row["category"]]
+        assert row["id"] == full_row["id"]
+        assert category["name"] == full_row["category_name"]
+        assert compact["main_categories"][category["main_category"]]["name"] == full_row["main_category_name"]
+        if full_row["kind_id"]:
+            assert compact["kinds"][row["kind"]]["name"] == full_row["kind_name"]
+        else:
+            assert compact["products"][row["product"]]["name"] == full_row["product_name"]
+        assert row["one"] == full_row["one"]
+        assert row["piece"] == full_row["piece"]
+
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?format=columnar")
+    assert response.status_code == 200
+    assert response.json["prices"]["id"] == [row[0] for row in compact["prices"]["rows"]]
+
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?format=xml")
+    assert response.status_code == 400
+
+
+def test_shops_detail_endpoint_language(client, shop_with_large_menu):
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?lang=en")
+    assert response.status_code == 200
+    prices = response.json["prices"]
+    assert len(prices) == 300
+    assert not [field for field in prices[0] if field.endswith("_en") or field.endswith("_nl")]
+
+    kind_row = next(row for row in prices if row["kind_id"])
+    product_row = next(row for row in prices if row["product_id"])
+    assert kind_row["kind_short_description"] == "EN"
+    # Missing translations fall back to dutch
+    assert product_row["product_short_description"] == "NL"
+    assert kind_row["category_name"].startswith("Large category")
+    assert kind_row["main_category_name"] == "Main"
+
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?lang=nl&format=compact")
+    assert response.status_code == 200
+    assert {kind["short_description"] for kind in response.json["kinds"]} == {"NL"}
+    # Only the texts of a lookup table are projected on a language
+    assert "short_description" not in response.json["categories"][0]
+    assert "short_description" not in response.json["main_categories"][0]
+    assert "name_en" not in response.json["categories"][0]
+
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}?lang=de")
+    assert response.status_code == 400
+
+
+def test_shop_category_slice(client, shop_with_large_menu):
+    category = Category.query.filter_by(shop_id=shop_with_large_menu.id, name="Large category 0").first()
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/categories/{category.id}")
+    assert response.status_code == 200
+    assert len(response.json["prices"]) == 100
+    assert {row["category_id"] for row in response.json["prices"]} == {str(category.id)}
+    assert ShopMenu.query.filter_by(shop_id=shop_with_large_menu.id, variant=f"category:{category.id}").first()
+
+    product_id = response.json["prices"][0]["product_id"] or response.json["prices"][0]["kind_id"]
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/categories/{category.id}/products/{product_id}")
+    assert response.status_code == 200
+    assert len(response.json["prices"]) == 1
+
+    # Unknown categories and products don't get a snapshot
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/categories/afda6a2f-293d-4d76-a4f9-1a2d08b56835")
+    assert response.status_code == 404
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/categories/{category.id}/products/not-a-uuid")
+    assert response.status_code == 404
+
+
+def test_shops_cache_status_conditional_get(client, shop_1):
+    response = client.get(f"/v1/shops/cache-status/{shop_1.id}")
+    assert response.status_code == 200
+    assert response.json["modified_at"]
+
+    response = client.get(f"/v1/shops/cache-status/{shop_1.id}", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_shop_price_changes(app, client, shop_with_large_menu):
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}")
+    etag = response.headers["ETag"]
+    since = datetime.utcnow()
+
+    changed, removed, repriced = ShopToPrice.query.filter_by(shop_id=shop_with_large_menu.id).limit(3).all()
+    changed.active = False
+    db.session.delete(removed)
+    # Changes of what a price row shows are changes of the row
+    repriced.price.one = 12.5
+    db.session.commit()
+
+    with mock.patch.dict(app.config, {"MENU_CHANGES_MARGIN": 0}):
+        for value in [since.isoformat(), etag, f"W/{etag}"]:
+            response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since={value}")
+            assert response.status_code == 200
+            assert response.json["added"] == []
+            assert {row["id"] for row in response.json["changed"]} == {str(changed.id), str(repriced.id)}
+            assert next(row for row in response.json["changed"] if row["id"] == str(changed.id))["active"] is False
+            assert next(row for row in response.json["changed"] if row["id"] == str(repriced.id))["one"] == 12.5
+            assert response.json["removed"] == [str(removed.id)]
+
+        until = response.json["until"]
+        response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since={until}")
+        assert response.json["changed"] == []
+        assert response.json["removed"] == []
+
+    # A change that was stamped before `until`, but committed after it, is included by the margin
+    until = datetime.fromisoformat(until)
+    ShopToPrice.query.update({"modified_at": until - timedelta(hours=1)})
+    ShopToPrice.query.filter_by(id=changed.id).update({"modified_at": until - timedelta(seconds=5)})
+    db.session.commit()
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since={until.isoformat()}")
+    rows = response.json["added"] + response.json["changed"]
+    assert [row["id"] for row in rows] == [str(changed.id)]
+
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since=yesterday")
+    assert response.status_code == 400
+
+    # Removed rows are only remembered for a while
+    assert purge_menu_tombstones(timedelta(0)) == 1
+    assert ShopToPriceTombstone.query.count() == 0
+    since = (datetime.utcnow() - timedelta(days=31)).isoformat()
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since={since}")
+    assert response.status_code == 410
+
+
+def test_shop_price_changes_moved_row(client, shop_with_large_menu, shop_2):
+    since = datetime.utcnow()
+    moved = ShopToPrice.query.filter_by(shop_id=shop_with_large_menu.id).first()
+    moved.shop_id = shop_2.id
+    db.session.commit()
+
+    # The row is removed from the menu of the previous shop, and added to the menu of the other one
+    response = client.get(f"/v1/shops/{shop_with_large_menu.id}/prices/changes?since={since.isoformat()}")
+    assert response.status_code == 200
+    assert response.json["removed"] == [str(moved.id)]
+    response = client.get(f"/v1/shops/{shop_2.id}/prices/changes?since={since.isoformat()}")
+    assert str(moved.id) in {row["id"] for row in response.json["added"] + response.json["changed"]}
+    assert response.json["removed"] == []
+
+
+def test_shop_menu_query_count(app, shop_with_large_menu, record_statements):
+    # Start without any relation in the identity map, but with the shop itself loaded
+    db.session.expire_all()
+    shop = Shop.query.filter_by(id=shop_with_large_menu.id).first()
+    with record_statements() as statements:
+        menu = build_shop_menu(shop)
+
+    assert len(menu["prices"]) == 300
+    kind_row = next(row for row in menu["prices"] if row["kind_id"])
+    assert kind_row["main_category_name"] == "Main"
+    assert {strain["name"] for strain in kind_row["strains"]} == {"Haze", "Kush"}
+    # One statement for the price relations and their relations, one for the strains
+    assert len(statements) <= 2, statements
+
+
+def test_shops_detail_endpoint_404(client):
+    response = client.get("/v1/shops/afda6a2f-293d-4d76-a4f9-1a2d08b56835", follow_redirects=True)
+    assert response.status_code == 404
+
+
 def test_shops_create_endpoint(client):
     data = {"name": "Naampje", "description": "Description"}
     response = client.post(f"/v1/shops", json=data, follow_redirects=True)